@@ -0,0 +1,95 @@
+"""
+Import time of the text-only modules, checked against a budget
+
+    python -m benchmarks.import_time
+    python -m benchmarks.import_time --modules src.Pipeline,src.Client --budget 2.5 --top 15
+
+Every module is imported in a fresh interpreter with python -X importtime, the best of
+--repeat runs is kept. The exit status is 1 when a module takes longer than --budget
+seconds or imports one of the --forbidden libraries (those of image embedding, OCR and
+evaluation, imported when first used) from a src module, so the check can run in CI.
+Forbidden libraries imported by third-party packages are listed as notes
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+MODULES = ('src.Pipeline', 'src.Rag_chain', 'src.Query_agent', 'src.Databases', 'src.Models')
+FORBIDDEN = ('torch', 'torchvision', 'PIL', 'datasets', 'pytesseract', 'ragas', 'lancedb', 'transformers',
+             'sentence_transformers', 'openai', 'langchain_community')
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def import_profile(module):
+    """
+    Cumulative import time (seconds) of the modules imported by importing module in a new
+    interpreter, the module that imported each of them, and the names of the modules
+    loaded (failed optional imports are timed too)
+    """
+
+    code = f'import sys, json; import {module}; print(json.dumps(sorted(sys.modules)))'
+    out = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=ROOT, capture_output=True, text=True)
+    if out.returncode != 0:
+        error = "\n".join(l for l in out.stderr.splitlines() if not l.startswith('import time:'))
+        raise RuntimeError(f'import {module} failed:\n{error}')
+    times, entries = {}, []
+    for line in out.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(cumulative) / 1e6  # a module is only imported once per run
+        entries.append(((len(name) - len(name.lstrip())) // 2, name.strip()))
+    importers, latest = {}, {}
+    for level, name in reversed(entries):  # a module is listed after the modules it imports, one level up
+        importers[name] = latest.get(level - 1)
+        latest[level] = name
+    return times, importers, set(json.loads(out.stdout.splitlines()[-1]))
+
+
+def first_importer(package, importers):
+    """
+    The module outside package that imported it first
+    """
+
+    name = package
+    while importers.get(name) and importers[name].split('.')[0] == package:
+        name = importers[name]
+    return importers.get(name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--modules', default=','.join(MODULES))
+    parser.add_argument('--budget', type=float, default=4.0, help='seconds per module')
+    parser.add_argument('--forbidden', default=','.join(FORBIDDEN))
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--top', type=int, default=10, help='slowest dependencies listed per module')
+    args = parser.parse_args()
+
+    forbidden = [f for f in args.forbidden.split(',') if f]
+    failures = []
+    for module in args.modules.split(','):
+        runs = [import_profile(module) for _ in range(args.repeat)]
+        times, importers, modules = min(runs, key=lambda r: r[0][module])
+        total = times[module]
+        loaded = {f: first_importer(f, importers) for f in forbidden if f in modules}
+        print(f"{module}: {total:.3f}s (budget {args.budget:.3f}s)")
+        packages = [(n, t) for n, t in times.items() if '.' not in n]  # submodules are counted in their package
+        for name, t in sorted(packages, key=lambda x: x[1], reverse=True)[:args.top]:
+            print(f"    {t:.3f}s  {name}")
+        if total > args.budget:
+            failures.append(f"{module} takes {total:.3f}s, over the {args.budget:.3f}s budget")
+        for name, importer in sorted(loaded.items()):
+            if importer is None or importer.startswith('src.') or importer == module:
+                failures.append(f"{module} loads {name} (imported by {importer or 'a submodule'})")
+            else:  # optional import of a third-party library, e.g. langchain_core tries transformers
+                print(f"    note: {name} is imported by {importer}")
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
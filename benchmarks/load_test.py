@@ -0,0 +1,219 @@
+"""
+Concurrent-user load test of RAGEval.query against local mock model endpoints
+
+    python -m benchmarks.load_test --levels 1,2,4,8,16 --duration 60 --think-time 5 --image-ratio 0.2
+
+Each level runs that many virtual users for --duration seconds. A user sends a text
+question, or an image query with probability --image-ratio, waits the response, then thinks
+for an exponentially distributed time of mean --think-time. Questions come from --questions
+(.jsonl or .txt as in Batch_eval) or from the synthetic manual indexed for the run.
+Model latencies are replayed by benchmarks.mock_backends, --latencies overrides them with
+a JSON file {"llm": [median, sigma, per_item], ...}
+
+The report (--out) holds report.json and levels.csv with the latency percentiles, throughput
+and error rate per level, the saturation point and latency.png. Runs with the same --seed
+follow the same user behaviour
+"""
+import argparse
+import contextlib
+import copy
+import csv
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import numpy as np
+from PIL import Image
+from langchain_core.runnables import RunnableLambda
+from src.Databases import ImageDatabase, TextDatabase, UnifiedDatabase
+from src.Feedback import FeedbackJournal
+from src.Pipeline import build_pipeline
+from benchmarks.mock_backends import (MockBackend, MockLLM, MockEmbeddings, MockCrossEncoder,
+                                      MockImageEmbedder)
+
+TOPICS = ['pump', 'valve', 'filter', 'motor', 'sensor', 'display', 'battery', 'cable', 'fan', 'nozzle']
+
+
+class MockStore(UnifiedDatabase):
+    """
+    UnifiedDatabase whose image embeddings come from the mock image endpoint
+    """
+
+    def _get_image_embedding(self, image):
+        return self.image_embedder(image)
+
+
+def build_corpus(sections=40, seed=0):
+    """
+    Synthetic manual: (text, page, section) spans, (figure, context, image) tuples and questions
+    """
+
+    rng = random.Random(seed)
+    spans, figures, questions = [], [], []
+    for s in range(sections):
+        topic, other = rng.choice(TOPICS), rng.choice(TOPICS)
+        section = f"{s + 1}. {topic.title()} maintenance"
+        for p in range(6):
+            spans.append((f"Check the {topic} {p} before connecting the {other}. The {topic} should be cleaned "
+                          f"every {rng.randint(2, 12)} weeks and replaced when the {other} reports a fault.\n",
+                          s, section))
+        colour = tuple(rng.randint(0, 255) for _ in range(3))
+        figures.append((f"Fig {s + 1} {topic} assembly.png", f"Figure {s + 1} shows the {topic} assembly",
+                        Image.new('RGB', (64, 64), colour)))
+        questions.append(f"How often should the {topic} be cleaned?")
+        questions.append(f"What should I check before connecting the {other}?")
+    return spans, figures, questions
+
+
+def build_rag(url, workdir, agent='tree', batched=False):
+    embedder = MockEmbeddings(url)
+    stores = []
+    for name in ('vb1', 'vb2'):
+        store = MockStore(name, os.path.join(workdir, 'lancedb'))
+        ImageDatabase.text_model_prep(store, embedder)
+        TextDatabase.model_prep(store, embedder, None)
+        store.image_embedder = MockImageEmbedder(url)
+        stores.append(store)
+    spans, figures, questions = build_corpus()
+    for store in stores:
+        store.upsert(iter(spans))
+        store.upsert(figures)
+    journal = FeedbackJournal(os.path.join(workdir, 'feedback.jsonl'), legacy_file=None)
+    journal.append(FeedbackJournal.record('Which fuse does the heater use?', True, 'A 10 A fuse.'))
+    llm = RunnableLambda(MockLLM(url))
+    config = {"agent": agent, "compression": "", "compression_budget": 256, "rerank_cap": 0, "time_budget": 0,
+              "uri": os.path.join(workdir, 'lancedb'), "feedback_file": journal.path}
+    rag = build_pipeline(stores, llm, llm, MockCrossEncoder(url), embedder, config)
+    return (rag._batched() if batched else rag), questions, [f[2] for f in figures]
+
+
+def virtual_user(rag, user, level, deadline, args, questions, images, records, lock):
+    rng = random.Random(f'{args.seed}-{level}-{user}')
+    while time.perf_counter() < deadline:
+        image = rng.random() < args.image_ratio
+        query = rng.choice(images) if image else rng.choice(questions)
+        start = time.perf_counter()
+        error = None
+        try:
+            copy.copy(rag).query(query, args.top_k)
+        except Exception as e:
+            error = type(e).__name__
+        with lock:
+            records.append({"level": level, "user": user, "kind": 'image' if image else 'text',
+                            "start": start, "latency": time.perf_counter() - start, "error": error})
+        time.sleep(min(rng.expovariate(1 / args.think_time) if args.think_time > 0 else 0,
+                       max(deadline - time.perf_counter(), 0)))
+
+
+def run_level(rag, level, args, questions, images):
+    records, lock = [], threading.Lock()
+    deadline = time.perf_counter() + args.duration
+    users = [threading.Thread(target=virtual_user, args=(rag, u, level, deadline, args, questions, images, records, lock))
+             for u in range(level)]
+    for u in users:
+        u.start()
+    for u in users:
+        u.join()
+    return records
+
+
+def summarize(level, records, duration):
+    ok = [r['latency'] for r in records if r['error'] is None]
+    row = {"users": level, "requests": len(records), "errors": len(records) - len(ok),
+           "error_rate": (len(records) - len(ok)) / len(records) if records else 0.0,
+           "throughput": len(ok) / duration}
+    for p in (50, 95, 99):
+        row[f"p{p}"] = float(np.percentile(ok, p)) if ok else None
+    for kind in ('text', 'image'):
+        lat = [r['latency'] for r in records if r['kind'] == kind and r['error'] is None]
+        row[f"{kind}_p95"] = float(np.percentile(lat, 95)) if lat else None
+    return row
+
+
+def saturation(rows, gain=1.1, blowup=2.0):
+    """
+    Largest level before throughput stops growing by gain or p95 exceeds blowup times the first level's
+    """
+
+    best = rows[0]['users']
+    for prev, row in zip(rows, rows[1:]):
+        if row['p95'] is None or row['throughput'] < prev['throughput'] * gain or \
+                row['p95'] > blowup * rows[0]['p95'] or row['error_rate'] > 0.01:
+            break
+        best = row['users']
+    return best
+
+
+def plot(rows, path):
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    users = [r['users'] for r in rows]
+    fig, ax = plt.subplots(figsize=(7, 4))
+    for p in ('p50', 'p95', 'p99'):
+        ax.plot(users, [r[p] for r in rows], marker='o', label=p)
+    ax.set_xscale('log', base=2)
+    ax.set_xlabel('concurrent users')
+    ax.set_ylabel('latency (s)')
+    ax2 = ax.twinx()
+    ax2.plot(users, [r['throughput'] for r in rows], color='grey', linestyle='--', label='throughput')
+    ax2.set_ylabel('queries / s')
+    ax.legend(loc='upper left')
+    fig.tight_layout()
+    fig.savefig(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--levels', default='1,2,4,8,16')
+    parser.add_argument('--duration', type=float, default=60.0)
+    parser.add_argument('--think-time', type=float, default=5.0)
+    parser.add_argument('--image-ratio', type=float, default=0.2)
+    parser.add_argument('--questions', default=None)
+    parser.add_argument('--latencies', default=None)
+    parser.add_argument('--agent', default='tree', choices=['tree', 'routed', 'plan'])
+    parser.add_argument('--batched', action='store_true', help='batch retrieval and reranking across users')
+    parser.add_argument('--top-k', type=int, default=2)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', default='load_test_results')
+    args = parser.parse_args()
+
+    latencies = None
+    if args.latencies:
+        with open(args.latencies) as f:
+            latencies = {k: tuple(v) for k, v in json.load(f).items()}
+    backend = MockBackend(latencies, seed=args.seed).start()
+    levels = [int(l) for l in args.levels.split(',')]
+    rows, records = [], []
+    with tempfile.TemporaryDirectory() as workdir, contextlib.redirect_stdout(io.StringIO()):
+        rag, questions, images = build_rag(backend.url, workdir, args.agent, args.batched)
+        if args.questions:
+            from src.Batch_eval import BatchEval  # pulls in ragas
+            questions = BatchEval.load_questions(args.questions)[0]
+        for level in levels:
+            level_records = run_level(rag, level, args, questions, images)
+            records += level_records
+            rows.append(summarize(level, level_records, args.duration))
+            print(json.dumps(rows[-1]), file=sys.stderr)
+    backend.stop()
+
+    os.makedirs(args.out, exist_ok=True)
+    report = {"config": vars(args), "latencies": backend.latencies, "levels": rows,
+              "saturation_users": saturation(rows)}
+    with open(os.path.join(args.out, 'report.json'), 'w') as f:
+        json.dump(report, f, indent=1)
+    with open(os.path.join(args.out, 'levels.csv'), 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+    plot(rows, os.path.join(args.out, 'latency.png'))
+    print(f"Saturation at {report['saturation_users']} users, report in {args.out}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,178 @@
+"""
+Local mock LLM, embedding, reranking and image embedding endpoints replaying realistic
+latencies, and the client wrappers plugging them into RAGEval in place of the real models
+
+Latencies are lognormal, given as (median seconds, sigma) per endpoint, plus a per-item
+cost for batched endpoints. Responses are deterministic functions of the request so runs
+are reproducible
+"""
+import hashlib
+import json
+import random
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import numpy as np
+import requests
+
+# endpoint -> (median seconds, sigma, seconds per item)
+LATENCIES = {
+    "llm": (0.8, 0.4, 0.0),  # Mistral-7B through the inference API
+    "embed": (0.01, 0.3, 0.002),  # sentence transformer on CPU
+    "rerank": (0.005, 0.3, 0.003),  # TinyBERT cross-encoder per pair
+    "image": (0.05, 0.3, 0.0),  # ViT
+}
+DIM = 64
+
+
+def _vector(text, dim=DIM):
+    """
+    Hashed bag of words, so questions retrieve the chunks sharing their words
+    """
+
+    v = np.zeros(dim, dtype=np.float32)
+    for w in text.lower().split():
+        v[int(hashlib.md5(w.strip('.,?!:').encode()).hexdigest(), 16) % dim] += 1
+    return (v / max(np.linalg.norm(v), 1e-9)).tolist()
+
+
+def _overlap(query, document):
+    q, d = set(query.lower().split()), set(document.lower().split())
+    return len(q & d) / max(len(q), 1)
+
+
+def _reply(prompt):
+    """
+    LLM output in the formats the MistralParsers of pages/rag.py expect
+    """
+
+    words = [w for w in prompt.split() if w.isalpha()][-6:]
+    topic = " ".join(words)
+    if '"sub_questions"' in prompt:  # PlanningAgent
+        return 'Plan: ' + json.dumps({"questions": [
+            {"question": f"What is {topic}?", "sub_questions": [f"Where is {topic}?", f"When is {topic} used?"]},
+            {"question": f"How does {topic} work?", "sub_questions": [f"What affects {topic}?"]}]})
+    if 'alternate questions' in prompt:
+        return f"alternate-questions :\n1. What is {topic}?\n2. How does {topic} work?"
+    if 'sub-question' in prompt or 'sub_question' in prompt:
+        return f"sub-question : What affects {topic}?"
+    return f"Answer: The manual describes {topic}."
+
+
+class MockBackend:
+    """
+    Threaded HTTP server with the /llm, /embed, /rerank and /image endpoints
+    """
+
+    def __init__(self, latencies=None, seed=0, port=0):
+        self.latencies = dict(LATENCIES, **(latencies or {}))
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        backend = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                endpoint = self.path.strip('/')
+                items = len(body.get('texts') or body.get('documents') or [0])
+                time.sleep(backend.delay(endpoint, items))
+                if endpoint == 'llm':
+                    out = {"text": _reply(body['prompt'])}
+                elif endpoint == 'embed':
+                    out = {"vectors": [_vector(t) for t in body['texts']]}
+                elif endpoint == 'rerank':
+                    out = {"scores": [_overlap(body['query'], d) for d in body['documents']]}
+                else:  # image
+                    out = {"vector": _vector(" ".join(f"c{int(c) // 32}" for c in body['colour']))}
+                data = json.dumps(out).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.server.daemon_threads = True
+        self.url = f'http://127.0.0.1:{self.server.server_port}'
+
+    def delay(self, endpoint, items=1):
+        median, sigma, per_item = self.latencies[endpoint]
+        with self.lock:
+            return self.random.lognormvariate(np.log(median), sigma) + per_item * items
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+
+class _Client:
+    def __init__(self, url):
+        self.url = url
+        self._local = threading.local()  # one keep-alive session per virtual user thread
+
+    def post(self, endpoint, payload):
+        if not hasattr(self._local, 'session'):
+            self._local.session = requests.Session()
+        response = self._local.session.post(f'{self.url}/{endpoint}', json=payload, timeout=120)
+        response.raise_for_status()
+        return response.json()
+
+
+class MockLLM(_Client):
+    """
+    Callable for RunnableLambda, accepts prompt values and strings like the HuggingFaceHub models
+    """
+
+    def __call__(self, prompt, **kwargs):
+        text = prompt.to_string() if hasattr(prompt, 'to_string') else str(prompt)
+        return self.post('llm', {"prompt": text})['text']
+
+
+class MockEmbeddings(_Client):
+    def embed_documents(self, texts):
+        return self.post('embed', {"texts": list(texts)})['vectors']
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+    def embed_queries(self, texts):
+        return self.embed_documents(texts)
+
+
+class MockCrossEncoder(_Client):
+    """
+    predict and rank with the signatures of sentence_transformers.CrossEncoder
+    """
+
+    def predict(self, pairs, batch_size=32, **kwargs):
+        lookup = {}
+        for q in {q for q, _ in pairs}:
+            docs = [d for p, d in pairs if p == q]
+            lookup.update(((q, d), s) for d, s in zip(docs, self.post('rerank', {"query": q, "documents": docs})['scores']))
+        return np.array([lookup[(q, d)] for q, d in pairs])
+
+    def rank(self, query, documents, top_k=None, return_documents=False, **kwargs):
+        scores = self.post('rerank', {"query": query, "documents": list(documents)})['scores']
+        ranked = sorted(({"corpus_id": i, "score": s, "text": d} for i, (s, d) in enumerate(zip(scores, documents))),
+                        key=lambda x: x['score'], reverse=True)
+        if not return_documents:
+            ranked = [{k: v for k, v in r.items() if k != 'text'} for r in ranked]
+        return ranked[:top_k]
+
+
+class MockImageEmbedder(_Client):
+    """
+    Stands in for the ViT of ImageDatabase, the vector is a function of the mean colour
+    """
+
+    def __call__(self, image):
+        colour = [float(c) for c in np.asarray(image.convert('RGB')).reshape(-1, 3).mean(axis=0)]
+        return self.post('image', {"colour": colour})['vector']
@@ -0,0 +1,72 @@
+"""
+Per-worker memory of N processes holding the same encoder, with private and with shared weights
+
+    python -m benchmarks.model_rss --workers 4 --model synthetic --size-mb 400
+    python -m benchmarks.model_rss --workers 4 --model pine
+
+RSS counts the shared pages in every worker, PSS splits them between the workers
+mapping them and is the number to compare for the machine total
+"""
+import argparse
+import multiprocessing as mp
+import tempfile
+import time
+
+
+def load(model, size_mb):
+    if model == 'synthetic':
+        import torch
+
+        width = 1024
+        layers = max(1, size_mb * 2 ** 20 // (4 * width * width))
+        return torch.nn.Sequential(*[torch.nn.Linear(width, width, bias=False) for _ in range(layers)])
+    from src import Models
+
+    return {"pine": Models.pine_embedding_model, "weaviate": Models.weaviate_embedding_model,
+            "cross": Models.load_cross, "image": lambda: Models.load_image_model("google/vit-base-patch16-224-in21k")[1]}[model]()
+
+
+def worker(model, size_mb, directory, ready, done, results):
+    from src.Model_host import share, rss
+
+    m = share(load(model, size_mb), f'benchmark-{model}-{size_mb}', directory)
+    ready.wait()  # every worker holds its model before measuring
+    time.sleep(0.5)
+    results.put(rss())
+    done.wait()
+    del m
+
+
+def run(workers, model, size_mb, directory):
+    ctx = mp.get_context('spawn')
+    ready, done, results = ctx.Barrier(workers + 1), ctx.Event(), ctx.Queue()
+    procs = [ctx.Process(target=worker, args=(model, size_mb, directory, ready, done, results)) for _ in range(workers)]
+    for p in procs:
+        p.start()
+    ready.wait(timeout=600)  # raises if a worker failed to load
+    sizes = [results.get() for _ in procs]
+    done.set()
+    for p in procs:
+        p.join()
+    return {k: sum(s[k] for s in sizes) / len(sizes) / 2 ** 20 for k in ('rss', 'pss')}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--model', default='synthetic', choices=['synthetic', 'pine', 'weaviate', 'cross', 'image'])
+    parser.add_argument('--size-mb', type=int, default=400, help='weights of the synthetic model')
+    args = parser.parse_args()
+
+    private = run(args.workers, args.model, args.size_mb, '')
+    with tempfile.TemporaryDirectory() as directory:
+        shared = run(args.workers, args.model, args.size_mb, directory)
+    print(f"{args.workers} workers, model {args.model}")
+    print(f"{'weights':<10}{'RSS/worker (MB)':>18}{'PSS/worker (MB)':>18}{'PSS total (MB)':>18}")
+    for name, r in (('private', private), ('shared', shared)):
+        print(f"{name:<10}{r['rss']:>18.1f}{r['pss']:>18.1f}{r['pss'] * args.workers:>18.1f}")
+    print(f"PSS saved per worker: {private['pss'] - shared['pss']:.1f} MB")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""
+Rerank time and quality of the bi-encoder pre-filter for several candidate caps
+
+    python -m benchmarks.rerank_cap --questions eval/questions.jsonl --caps 0,4,8,16
+    python -m benchmarks.rerank_cap --mock --caps 0,4,8,16
+
+The agent fetches the contexts of every question once, each cap then reranks the same
+contexts (cap 0 sends all of them to the cross-encoder). Each cap is timed (pre-filter plus
+rerank) cold, with only the chunk vectors kept by the retrieval in the embedding cache
+(the question and the contexts without a stored vector are embedded), and warm, run again
+with everything cached. reused is the share of contexts with a stored vector. Quality is
+measured against the uncapped selection: recall is the share of its best contexts also
+selected with the cap, top1 how often the best context is the same. --mock runs on the synthetic manual and mock
+endpoints of benchmarks.load_test, otherwise the models of the server are loaded and the
+stores at --uri are used
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import tempfile
+import numpy as np
+from src.Cache import embedder_name, embeddings
+
+
+def real_rag(uri, agent):
+    from src import Models, Ingestion
+    from src.Pipeline import build_pipeline, config_from_env
+
+    extractor, image_model = Models.load_image_model("google/vit-base-patch16-224-in21k")
+    weaviate_embed, pinecone_embed = Models.weaviate_embedding_model(), Models.pine_embedding_model()
+    vb_list = Ingestion.vector_databases(extractor, image_model, weaviate_embed, pinecone_embed, uri)
+    config = dict(config_from_env(), uri=uri, agent=agent, rerank_cap=0)
+    return build_pipeline(vb_list, Models.load_chat_model(), Models.load_q_model(), Models.load_cross(),
+                          weaviate_embed, config)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--questions', default=None)
+    parser.add_argument('--caps', default='0,4,8,16')
+    parser.add_argument('--agent', default='tree', choices=['tree', 'routed', 'plan'])
+    parser.add_argument('--uri', default='lancedb/rag')
+    parser.add_argument('--mock', action='store_true')
+    parser.add_argument('--limit', type=int, default=20, help='questions used')
+    parser.add_argument('--out', default=None, help='json report path')
+    args = parser.parse_args()
+
+    caps = [int(c) for c in args.caps.split(',')]
+    if 0 not in caps:
+        caps.insert(0, 0)
+    with tempfile.TemporaryDirectory() as workdir, contextlib.redirect_stdout(io.StringIO()):
+        if args.mock:
+            from benchmarks.load_test import build_rag
+            from benchmarks.mock_backends import MockBackend
+
+            backend = MockBackend().start()
+            rag, questions, _ = build_rag(backend.url, workdir, args.agent)
+        else:
+            rag, questions = real_rag(args.uri, args.agent), []
+        if args.questions:
+            from src.Batch_eval import BatchEval  # pulls in ragas
+            questions = BatchEval.load_questions(args.questions)[0]
+        rag.rerank_prep(0)  # the bi-encoder of the first store, the cap is given per run
+        rag.trace = {}
+        name = embedder_name(rag.prefilter_embedder)
+        rows = {c: {"candidates": [], "reused": [], "prefilter_cold": [], "total_cold": [], "prefilter_warm": [],
+                    "total_warm": [], "recall": [], "top1": []} for c in caps}
+        for question in questions[:args.limit]:
+            embeddings.clear()
+            contexts = []
+            for c in rag.query_agent.invoke(question).split('@@'):
+                if c not in contexts:
+                    contexts.append(c)
+            stored = {c: embeddings.get((name, c)) for c in contexts}  # kept by the retrieval
+            stored = {c: v for c, v in stored.items() if v is not None}
+            selected = {}
+            for cap in caps:
+                row = rows[cap]
+                row["reused"].append(len(stored) / max(len(contexts), 1))
+                embeddings.clear()
+                for c, v in stored.items():
+                    embeddings.put((name, c), v)
+                for run in ('cold', 'warm'):
+                    selected[cap] = rag._rerank(question, contexts, cap)
+                    row[f"prefilter_{run}"].append(rag.trace['prefilter_time'])
+                    row[f"total_{run}"].append(rag.trace['prefilter_time'] + rag.trace['rerank_time'])
+                row["candidates"].append(rag.trace['rerank_candidates'])
+                base = selected[0]
+                row["recall"].append(len(set(base) & set(selected[cap])) / max(len(base), 1))
+                row["top1"].append(float(bool(base) and bool(selected[cap]) and base[0] == selected[cap][0]))
+        if args.mock:
+            backend.stop()
+
+    report = {"agent": args.agent, "questions": len(rows[0]['recall']), "best": rag.best,
+              "caps": {str(c): {k: float(np.mean(v)) if v else None for k, v in r.items()} for c, r in rows.items()}}
+    print(f"{'cap':>5} {'candidates':>10} {'reused':>7} {'cold pre ms':>11} {'cold ms':>8} {'warm pre ms':>11} "
+          f"{'warm ms':>8} {'recall':>7} {'top1':>6}")
+    for c, r in report['caps'].items():
+        print(f"{c:>5} {r['candidates']:>10.1f} {r['reused']:>7.2f} {r['prefilter_cold'] * 1e3:>11.1f} "
+              f"{r['total_cold'] * 1e3:>8.1f} {r['prefilter_warm'] * 1e3:>11.1f} {r['total_warm'] * 1e3:>8.1f} "
+              f"{r['recall']:>7.2f} {r['top1']:>6.2f}")
+    if args.out:
+        os.makedirs(os.path.dirname(args.out) or '.', exist_ok=True)
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=1)
+
+
+if __name__ == '__main__':
+    main()
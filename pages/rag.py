@@ -8,172 +8,101 @@ st.set_page_config(
     initial_sidebar_state="collapsed"
 )
 from uuid import uuid4
-from llama_index.core import Settings
-from langchain_openai.embeddings import OpenAIEmbeddings
+import copy
 import os
-from sentence_transformers import SentenceTransformer
+import uuid
+from PIL import Image
+from langchain_core.runnables import RunnableLambda
 from langchain.text_splitter import *
 from langsmith import Client
-from openai import OpenAI
-import base64
-from io import BytesIO
-import requests
-import matplotlib.pyplot as plt
 from src.Rag_chain import *
 from src.Query_agent import *
+from src.Models import ChatGPT
+from src.Client import RAGClient
+from src.Figures import FigureCache
+from src.Feedback import FeedbackJournal
+from src.Cache import image_hash
+from src.Pipeline import get_pipeline, config_from_env
 from langsmith.run_trees import RunTree
 from src.Databases import *
 showWarningOnDirectExecution = False
 
 
-# Embedding Model
-class SentenceTransformerEmbeddings:
-      """
-        Wrapper Class for SentenceTransformer Class
-      """
-      def __init__(self, model_name: str):
-        """
-          Initiliases a Sentence Transformer
-        """
-        self.model = SentenceTransformer(model_name)
-
-      def embed_documents(self, texts):
-        """
-        Returns a list of embeddings for the given texts.
-        """
-        return self.model.encode(texts, convert_to_tensor=True).tolist()
-
-      def embed_query(self, text):
-        """
-          Returns a list of embeddings for the given text.
-        """
-        return self.model.encode(text, convert_to_tensor=True).tolist()
-
-
-# Parser
-class MistralParser:
-  """
-    Wrapper Class for StrOutputParser Class
-    Custom made for Mistral models
-  """
-
-  def __init__(self, stopword='Answer:'):
-    """
-      Initiliases a StrOutputParser as the base parser
-    """
-    self.parser = StrOutputParser()
-    self.stopword = stopword
-
-  def invoke(self, query):
-    """
-      Invokes the parser and finds the Model response
-    """
-    ans = self.parser.invoke(query)
-    return ans[ans.find(self.stopword)+len(self.stopword):].strip()
+pdf_file = st.session_state['pdf_file']
+file_name = pdf_file
+image_folder = f'./figures_{file_name}'
+os.environ["HUGGINGFACEHUB_API_TOKEN"] = st.secrets["HUGGINGFACEHUB_API_TOKEN"]
+os.environ["LANGCHAIN_PROJECT"] = st.secrets["LANGCHAIN_PROJECT"]
+feedback_file = "./feedback_journal.jsonl"
+api_url = os.getenv('RAG_API_URL', st.secrets.get('RAG_API_URL', ''))
 
 
-class ChatGPT:
-  """
-    Wrapper Class for ChatGPT Class
-  """
+@st.cache_resource(show_spinner=False)
+def rag_client(api_url):
+    return RAGClient(api_url)
 
-  def __init__(self, model, api_key, template):
-    self.model = model
-    self.api_key = api_key
-    self.client = OpenAI(api_key=api_key)
-    self.template = template
 
-  def image(self,image):
+@st.cache_resource(show_spinner=False)
+def openai_resources(gpt_key):
     """
-      Image to Text Conversion
+    OpenAI clients and ChatGPT wrappers, built once per process
     """
+    from langchain_openai.embeddings import OpenAIEmbeddings
+    from openai import OpenAI
 
-    def pil_to_base64(img):
-      buffered = BytesIO()
-      img.save(buffered, format="PNG")
-      img_str = base64.b64encode(buffered.getvalue()).decode("utf-8")
-      return img_str
-
-    image_str = pil_to_base64(image)
-    headers = {"Content-Type": "application/json","Authorization": f"Bearer {self.api_key}"}
-    payload = {"model": self.model,
-    "messages": [{"role": "user",
-       "content": [{"type": "text","text": self.template},{"type": "image_url","image_url": {"url": f"data:image/jpeg;base64,{image_str}"}}]
-      }
-    ],"max_tokens": 20}
-    response = requests.post("https://api.openai.com/v1/chat/completions", headers=headers, json=payload)
-    res = response.json()
-    if 'error' not in res:
-      return res['choices'][0]['message']['content']
-    else:
-      return res['error']['message']
-
-  def chat(self, prompt):
-    """
-      Text Conversation
-    """
-    message = [{"role":"user", "content":prompt.messages[0].content}]
-    return self.client.chat.completions.create(messages=message, model=self.model).choices[0].message.content
+    client = OpenAI(api_key=gpt_key)
+    embeddings = OpenAIEmbeddings(model='text-embedding-3-large')
+    gpt_model = RunnableLambda(ChatGPT("gpt-4o", api_key=gpt_key, template="""You are an assistant for question-answering tasks.
+        Use the following pieces of retrieved context to answer the question accurately.
+        Question: {question}
+        Context: {context}
+        Answer:""").chat)
+    gq_model = RunnableLambda(ChatGPT('gpt-3.5-turbo', api_key=gpt_key, template="""You are an assistant for question-answering tasks.
+        Use the following pieces of retrieved context to answer the question accurately.
+        Question: {question}
+        Context: {context}
+        Answer:""").chat)
+    return client, embeddings, gpt_model, gq_model
 
 
-Settings.embed_model = st.session_state['Settings.embed_model']
-processor, vision_model = st.session_state['processor'], st.session_state['vision_model']
-bi_encoder = st.session_state['bi_encoder']
-chat_model = st.session_state['chat_model']
-cross_model = st.session_state['cross_model']
-extractor, image_model = st.session_state['extractor'], st.session_state['image_model']
-pinecone_embed = st.session_state['pinecone_embed']
-weaviate_embed = st.session_state['weaviate_embed']
+@st.cache_resource(show_spinner=False)
+def langsmith_client(url, key):
+    return Client(api_url=url, api_key=key)
 
-pdf_file = st.session_state['pdf_file']
-file_name = pdf_file
-image_folder = f'./figures_{file_name}'
-url = st.secrets["WEAVIATE_URL"]
-v_key = st.secrets["WEAVIATE_V_KEY"]
-gpt_key = st.secrets["GPT_KEY"]
-os.environ["HUGGINGFACEHUB_API_TOKEN"] = st.secrets["HUGGINGFACEHUB_API_TOKEN"]
-os.environ["LANGCHAIN_PROJECT"] = st.secrets["LANGCHAIN_PROJECT"]
-os.environ["OPENAI_API_KEY"] = gpt_key
-f_url = st.secrets['FEEDBACK_URL']
-f_api = st.secrets['FEEDBACK_API']
-feedback_file = "./feedback_loop.txt"
-im_db_url = st.secrets["IMAGE_URL"]
-im_db_key = st.secrets["IMAGE_API"]
-txt_db_url = st.secrets["TEXT_URL"]
-txt_db_key = st.secrets["TEXT_API"]
 
 fd = False
-client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
-embeddings = OpenAIEmbeddings(model='text-embedding-3-large')
-mistral_parser = RunnableLambda(MistralParser().invoke)
-vb_list = st.session_state['vb_list']
-q_model = st.session_state['q_model']
-alt_parser = RunnableLambda(MistralParser('alternate-questions :\n').invoke)
-sub_parser = RunnableLambda(MistralParser('sub-question : ').invoke)
-image_parser = RunnableLambda(MistralParser().invoke)
-gpt_model = RunnableLambda(ChatGPT("gpt-4o", api_key=gpt_key, template="""You are an assistant for question-answering tasks.
-    Use the following pieces of retrieved context to answer the question accurately.
-    Question: {question}
-    Context: {context}
-    Answer:""").chat)
-gq_model = RunnableLambda(ChatGPT('gpt-3.5-turbo', api_key=gpt_key, template="""You are an assistant for question-answering tasks.
-    Use the following pieces of retrieved context to answer the question accurately.
-    Question: {question}
-    Context: {context}
-    Answer:""").chat)
-pine_embed = st.session_state['pinecone_embed']
-feedback_db = TextDatabase('feedback', './lancedb/rag')
-feedback_db.model_prep(weaviate_embed, RecursiveCharacterTextSplitter(chunk_size=1330, chunk_overlap=35))
-with open('./feedback_loop.txt', 'r') as f:
-  feedback = f.read()
-feedback_db.upsert(feedback)
-
-req = RAGEval(vb_list, cross_model)
-req.model_prep(chat_model, mistral_parser)
-req.query_agent_prep(q_model, (alt_parser, sub_parser, image_parser))
-req.feedback_prep(uri='./lancedb/rag', table_name='feedback',
-                  file=feedback_file, embedder=weaviate_embed,
-                  splitter=RecursiveCharacterTextSplitter(chunk_size=1330, chunk_overlap=35))
+if api_url:  # thin client of the HTTP service in src/Server.py
+    req = rag_client(api_url)
+else:
+    from llama_index.core import Settings
+
+    Settings.embed_model = st.session_state['Settings.embed_model']
+    processor, vision_model = st.session_state['processor'], st.session_state['vision_model']
+    bi_encoder = st.session_state['bi_encoder']
+    chat_model = st.session_state['chat_model']
+    cross_model = st.session_state['cross_model']
+    extractor, image_model = st.session_state['extractor'], st.session_state['image_model']
+    pinecone_embed = st.session_state['pinecone_embed']
+    weaviate_embed = st.session_state['weaviate_embed']
+
+    url = st.secrets["WEAVIATE_URL"]
+    v_key = st.secrets["WEAVIATE_V_KEY"]
+    gpt_key = st.secrets["GPT_KEY"]
+    os.environ["OPENAI_API_KEY"] = gpt_key
+    f_url = st.secrets['FEEDBACK_URL']
+    f_api = st.secrets['FEEDBACK_API']
+    im_db_url = st.secrets["IMAGE_URL"]
+    im_db_key = st.secrets["IMAGE_API"]
+    txt_db_url = st.secrets["TEXT_URL"]
+    txt_db_key = st.secrets["TEXT_API"]
+
+    client, embeddings, gpt_model, gq_model = openai_resources(gpt_key)
+    vb_list = st.session_state['vb_list']
+    q_model = st.session_state['q_model']
+    pine_embed = st.session_state['pinecone_embed']
+    # the pipeline is built once per process, per-session query state lives on this copy
+    req = copy.copy(get_pipeline(vb_list, chat_model, q_model, cross_model, weaviate_embed,
+                                 dict(config_from_env(), uri='./lancedb/rag', feedback_file=feedback_file)))
 
 if "run_id" not in st.session_state:
     st.session_state.run_id = uuid4()
@@ -183,8 +112,10 @@ if 'image' not in st.session_state:
     st.session_state['image'] = []
 if 'conv_id' not in st.session_state:
     st.session_state['conv_id'] = {}
+if 'profile' not in st.session_state:  # open the page with ?profile=1 to profile the session's queries
+    st.session_state['profile'] = True if st.query_params.get('profile') in ('1', 'true') else None
 
-client = Client(api_url=st.secrets["LANGSMITH_URL"], api_key=st.secrets["LANGSMITH_API_KEY"])
+client = langsmith_client(st.secrets["LANGSMITH_URL"], st.secrets["LANGSMITH_API_KEY"])
 mes = []
 for message in st.session_state.messages:
     if type(message['content']) is dict:
@@ -222,24 +153,28 @@ def fbcb():
 
     s = f"The feedback for {prompt} "
     fb = "NEGATIVE " if st.session_state.fb_k["score"] == '👎' else "POSITIVE "
+    response = ""
     for _ in st.session_state.messages:
         if st.session_state.fb_k['text'] is None:
             st.session_state.fb_k['text'] = ""
         s += f'is {fb} and the response is '
         if fb == "NEGATIVE ":
-            s += st.session_state.fb_k['text']
+            response = st.session_state.fb_k['text']
         else:
             fsa = [d['content'] for d in st.session_state.messages if d["role"] == 'assistant']
             if isinstance(fsa[-1], str):
-                s += fsa[-1]
+                response = fsa[-1]
             else:
-                s += fsa[-1]['text']
+                response = fsa[-1]['text']
+        s += response
         s += '\n'
-    with open('./feedback.txt', 'r+') as fd:  # feedback records all feedback for this run
-        fd.write(s)
-    with open('./feedback_loop.txt', 'r+') as fd:  # feedback loop records feedback for all runs
+    with open('./feedback.txt', 'a') as fd:  # feedback records all feedback for this run
         fd.write(s)
-    feedback_db.upsert(s)
+    if api_url:
+        req.feedback(prompt, fb == "POSITIVE ", response)
+    else:  # feedback journal records feedback for all runs
+        req.feedback_journal.append(FeedbackJournal.record(prompt, fb == "POSITIVE ", response))
+        req.feedback_journal.sync(req.fd_db)
     with open('./feedback.txt', 'r') as fd:
         feed = fd.read()
     client.create_feedback(
@@ -251,26 +186,23 @@ def fbcb():
     )
 
 
-def plot_images(images_path, output_path, image_name, top_k=5):
-    images_shown = 0
+@st.cache_resource(show_spinner=False)
+def figure_cache(api_url):
+    """
+    Process-wide cache of encoded figures, shared by all sessions and reruns
+    """
+    return FigureCache(RAGClient(api_url).figure) if api_url else FigureCache()
 
-    plt.figure(figsize=(16, 9))
-    for img_path in images_path:
-        if os.path.isfile(img_path):
-            plt.subplot(2, 3, images_shown + 1)
-            plt.imshow(Image.open(img_path))
-            plt.xticks([])
-            plt.yticks([])
 
-            images_shown += 1
-            if images_shown >= top_k:
-                break
+figures = figure_cache(api_url)
 
-    # Ensure the directory exists
+
+def plot_images(images_path, output_path, image_name, top_k=5):
+    images = [os.path.basename(p) for p in images_path]
     os.makedirs(output_path, exist_ok=True)
     full_image_path = os.path.join(output_path, image_name)
-    plt.savefig(full_image_path)
-    plt.close()  # Close the plot to free up memory
+    with open(full_image_path, 'wb') as f:
+        f.write(figures.montage(file_name, images, top_k))
     return full_image_path
 
 
@@ -282,37 +214,41 @@ if uploaded_file is not None:
     up_image.save(name)
 
     associated_text = st.text_area("Provide a query wrt to image if any else input \'None\' ")
-    while True:
-        if len(associated_text):
-            result = req.query(up_image, 5)  # dict
-            images = result['image']  # list
-            image_context = "Context for the image:\n" + "".join(result['text'])  # str
-
-            if associated_text.lower().strip() != 'none':
-                prompt = associated_text
-                st.session_state.messages.append({"role": "user", "content": prompt})
-                ai_response = req.query("Given " + image_context + '; Here is the user query: ' + prompt)['text']
-                user_response = {"role": "user", "content": prompt}
-            else:
-                prompt = ""
-                ai_response = image_context
-                user_response = {}
-
-            conv_id = uuid.uuid4()
-            st.session_state.messages.append({"role": "assistant", "content": ai_response})
-            st.session_state['image'] += [name] + images
-            st.session_state['conv_id'][conv_id] = {
-                "user_messages": user_response,
-                "ai_messages": {"role": "assistant", "content": ai_response},
-                "images": images  # list
-            }
-            break
+    if 'image_queries' not in st.session_state:
+        st.session_state['image_queries'] = set()
+    image_query = (image_hash(up_image), associated_text.strip())
+    # reruns keep the upload, answer each (image, query) pair once
+    if len(associated_text) and image_query not in st.session_state['image_queries']:
+        st.session_state['image_queries'].add(image_query)
+        result = req.query(up_image, 5, profile=st.session_state['profile'], document=file_name)  # dict
+        images = result['image']  # list
+        image_context = "Context for the image:\n" + "".join(result['text'])  # str
+
+        if associated_text.lower().strip() != 'none':
+            prompt = associated_text
+            st.session_state.messages.append({"role": "user", "content": prompt})
+            ai_response = req.query("Given " + image_context + '; Here is the user query: ' + prompt,
+                                    profile=st.session_state['profile'], document=file_name)['text']
+            user_response = {"role": "user", "content": prompt}
+        else:
+            prompt = ""
+            ai_response = image_context
+            user_response = {}
+
+        conv_id = uuid.uuid4()
+        st.session_state.messages.append({"role": "assistant", "content": ai_response})
+        st.session_state['image'] += [name] + images
+        st.session_state['conv_id'][conv_id] = {
+            "user_messages": user_response,
+            "ai_messages": {"role": "assistant", "content": ai_response},
+            "images": images  # list
+        }
 
 if prompt := st.chat_input("What's Up?"):
     prompt = prompt
     fd = True
     st.session_state.messages.append({"role": "user", "content": prompt})
-    response = req.query(prompt, 5)  # prompt is a str
+    response = req.query(prompt, 5, profile=st.session_state['profile'], document=file_name)  # prompt is a str
     images = response['image']
     st.session_state.messages.append({"role": "assistant", "content": response['text']})
     conv_id = uuid.uuid4()
@@ -322,6 +258,7 @@ if prompt := st.chat_input("What's Up?"):
         "images": images
     }
 
+latest = list(st.session_state['conv_id'])[-1:]
 for conv_id in st.session_state['conv_id']:
     dic = st.session_state['conv_id'][conv_id]
     user_messages, ai_messages, images = dic['user_messages'], dic['ai_messages'], dic['images']
@@ -335,8 +272,11 @@ for conv_id in st.session_state['conv_id']:
         for image in images:
             if image not in unique_images:
                 unique_images.append(image)
-        for image in unique_images:
-            st.image(Image.open(os.path.join(image_folder, image)), use_column_width=True)
+        for image in unique_images:  # earlier turns show thumbnails
+            if conv_id in latest:
+                st.image(figures.get(file_name, image, 'display'), use_column_width=True)
+            else:
+                st.image(figures.get(file_name, image, 'thumb'))
 
 if fd:
     with st.form('form'):
@@ -0,0 +1,10 @@
+#!/bin/zsh
+
+trap 'on_exit' SIGINT
+
+on_exit() {
+    exit 0
+}
+
+uvicorn src.Server:app --host 0.0.0.0 --port 8000 --workers ${RAG_WORKERS:-2} &
+wait $!
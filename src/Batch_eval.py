@@ -0,0 +1,227 @@
+import copy
+import hashlib
+import inspect
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+from datasets import Dataset
+from ragas import evaluate
+from ragas.metrics import (
+    faithfulness,
+    answer_relevancy,
+    context_recall,
+    context_precision
+)
+from src.Cache import embedder_name
+from src.Query_agent import ContextAgent
+
+
+class BatchEval:
+    """
+    Batch RAGAS evaluation over a question set
+
+    Utility method:
+    1. Prepare a RAGEval object as usual (model_prep, query_agent_prep, feedback_prep)
+    2. Call BatchEval(rag, cache_dir), with model_names (chat model, query model) when the
+       models do not carry their name
+    3. Call run(questions, ground_truths, out_dir)
+
+    Pipeline outputs are cached per (question, pipeline fingerprint) and metrics per
+    (question, answer, contexts, ground truth), so a re-run only recomputes what changed
+    """
+
+    metrics = [context_precision, context_recall, faithfulness, answer_relevancy]
+
+    def __init__(self, rag, cache_dir='./eval_cache', max_workers=4, model_names=None):
+        self.rag = rag
+        self.model_names = model_names
+        self.cache_dir = cache_dir
+        self.max_workers = max_workers
+        os.makedirs(os.path.join(cache_dir, 'outputs'), exist_ok=True)
+        os.makedirs(os.path.join(cache_dir, 'metrics'), exist_ok=True)
+
+    @staticmethod
+    def _key(*parts):
+        return hashlib.sha256(json.dumps(parts, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def _read(self, kind, key):
+        path = os.path.join(self.cache_dir, kind, key + '.json')
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+    def _write(self, kind, key, value):
+        path = os.path.join(self.cache_dir, kind, key + '.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(value, f)
+        os.replace(path + '.tmp', path)
+
+    @staticmethod
+    def _model_name(model):
+        """
+        Name of a model, looked up through RunnableLambda wrappers: the object of a bound
+        method (e.g. ChatGPT.chat) or the model called by a closure (e.g. Batching.limited)
+        """
+
+        func = getattr(model, 'func', None)
+        if callable(func):
+            inner = getattr(func, '__self__', None)
+            if inner is None:
+                cells = [c.cell_contents for c in getattr(func, '__closure__', None) or ()]
+                inner = next((c for c in cells if hasattr(c, 'invoke') or hasattr(c, 'chat')), None)
+            if inner is not None:
+                return f"{type(model).__name__}({BatchEval._model_name(inner)})"
+        for attr in ('model_name', 'model_id', 'repo_id', 'model'):
+            if isinstance(getattr(model, attr, None), str):
+                return f"{type(model).__name__}:{getattr(model, attr)}"
+        return type(model).__name__
+
+    @staticmethod
+    def _settings(agent):
+        """
+        Public class-level settings of the agent with their current values (fusion, budgets,
+        weights...) and those of its sub-agents, and a hash of the source of its module,
+        which holds the prompts
+        """
+
+        def plain(v):
+            return v is None or isinstance(v, (str, int, float, bool)) or \
+                (isinstance(v, (list, tuple)) and all(plain(x) for x in v))
+
+        names = {n for c in type(agent).__mro__ for n in vars(c) if not n.startswith('_')}
+        settings = {n: getattr(agent, n) for n in sorted(names) if plain(getattr(agent, n, object()))}
+        for name, value in vars(agent).items():
+            if isinstance(value, ContextAgent):
+                settings[name] = BatchEval._settings(value)
+        source = inspect.getsource(inspect.getmodule(type(agent)))
+        settings['source'] = hashlib.sha256(source.encode('utf-8')).hexdigest()
+        settings['agent'] = type(agent).__name__
+        return settings
+
+    def fingerprint(self):
+        """
+        Identifies the pipeline configuration and corpus the cached outputs were produced
+        with: prompt, models (model_names when given), agent and its settings, compression, rerank cap and
+        pre-filter embedder, time budget, and per store its quantization, small-to-big child size,
+        table versions and ingested documents
+        """
+
+        stores = []
+        for vb in list(self.rag.vb_list) + [self.rag.fd_db]:
+            path = os.path.join(vb.uri, 'ingested.json')
+            ingested = None
+            if os.path.exists(path):
+                with open(path) as f:
+                    ingested = json.load(f)
+            stores.append({"versions": vb.versions(), "quantization": vb.quantization,
+                           "child_size": getattr(vb, 'child_size', 0), "ingested": ingested})
+        prefilter = self.rag.rerank_cap and embedder_name(self.rag.prefilter_embedder)
+        models = self.model_names or (self._model_name(self.rag.chat_model), self._model_name(self.rag._agent_args[0]))
+        return self._key(self.rag.template, self.rag.best, list(models), self.rag.compression,
+                         self.rag._agent_args[2], self._settings(self.rag.agent), stores,
+                         self.rag.rerank_cap, prefilter, self.rag.time_budget)
+
+    def _answer(self, rag, question):
+        """
+        Runs the pipeline for one question on a shallow copy of the RAGEval object,
+        as query keeps per-question state on the instance
+        """
+
+        start = time.perf_counter()
+        result = copy.copy(rag).query(question)
+        return {
+            "answer": result['text'],
+            "contexts": [result['context']],
+            "query_time": time.perf_counter() - start
+        }
+
+    def outputs(self, questions):
+        """
+        Returns pipeline outputs for the questions, running only uncached ones
+        """
+
+        fp = self.fingerprint()
+        keys = [self._key(fp, q) for q in questions]
+        outputs = {k: self._read('outputs', k) for k in keys}
+        pending = [(k, q) for k, q in zip(keys, questions) if outputs[k] is None]
+        print(f"Pipeline: {len(pending)} to run, {len(questions) - len(pending)} cached")
+        batched = self.rag._batched()  # same pipeline as query_many, keeping per-question timings
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            for (k, q), out in zip(pending, pool.map(lambda q: self._answer(batched, q), [q for _, q in pending])):
+                self._write('outputs', k, out)
+                outputs[k] = out
+        return [outputs[k] for k in keys]
+
+    def scores(self, questions, outputs, ground_truths, raise_exceptions=False):
+        """
+        Returns RAGAS metrics per question, evaluating only rows whose inputs changed
+        in a single ragas.evaluate call
+        """
+
+        keys = [self._key(q, o['answer'], o['contexts'], g) for q, o, g in zip(questions, outputs, ground_truths)]
+        scores = {k: self._read('metrics', k) for k in keys}
+        pending = [i for i, k in enumerate(keys) if scores[k] is None]
+        print(f"RAGAS: {len(pending)} to evaluate, {len(keys) - len(pending)} cached")
+        if len(pending) != 0:
+            dataset = Dataset.from_dict({
+                "question": [questions[i] for i in pending],
+                "answer": [outputs[i]['answer'] for i in pending],
+                "contexts": [outputs[i]['contexts'] for i in pending],
+                "ground_truth": [ground_truths[i] for i in pending]
+            })
+            df = evaluate(dataset=dataset, metrics=self.metrics, raise_exceptions=raise_exceptions).to_pandas()
+            names = [m.name for m in self.metrics]
+            for i, row in zip(pending, df.to_dict('records')):
+                value = {n: (None if pd.isna(row.get(n)) else float(row[n])) for n in names}
+                self._write('metrics', keys[i], value)
+                scores[keys[i]] = value
+        return [scores[k] for k in keys]
+
+    def run(self, questions, ground_truths=None, out_dir='./eval_results', raise_exceptions=False):
+        """
+        Evaluates the question set and writes per_question.csv and aggregate.json to out_dir
+        """
+
+        if ground_truths is None:
+            ground_truths = [""] * len(questions)
+        timing = {}
+        start = time.perf_counter()
+        outputs = self.outputs(questions)
+        timing['pipeline'] = time.perf_counter() - start
+        start = time.perf_counter()
+        scores = self.scores(questions, outputs, ground_truths, raise_exceptions)
+        timing['evaluation'] = time.perf_counter() - start
+        timing['total'] = timing['pipeline'] + timing['evaluation']
+
+        rows = [{"question": q, "answer": o['answer'], "ground_truth": g, "query_time": o['query_time'], **s}
+                for q, o, g, s in zip(questions, outputs, ground_truths, scores)]
+        df = pd.DataFrame(rows)
+        names = [m.name for m in self.metrics]
+        aggregate = {
+            "questions": len(questions),
+            "metrics": {n: (None if df[n].isna().all() else float(df[n].mean())) for n in names},
+            "mean_query_time": float(df['query_time'].mean()) if len(df) else 0.0,
+            "timing": timing
+        }
+        os.makedirs(out_dir, exist_ok=True)
+        df.to_csv(os.path.join(out_dir, 'per_question.csv'), index=False)
+        with open(os.path.join(out_dir, 'aggregate.json'), 'w') as f:
+            json.dump(aggregate, f, indent=2)
+        return df, aggregate
+
+    @staticmethod
+    def load_questions(path):
+        """
+        Reads a question set from a .jsonl file of {"question", "ground_truth"} records
+        or a plain text file with one question per line
+        """
+
+        with open(path) as f:
+            lines = [l.strip() for l in f if l.strip()]
+        if path.endswith('.jsonl'):
+            records = [json.loads(l) for l in lines]
+            return [r['question'] for r in records], [r.get('ground_truth', "") for r in records]
+        return lines, [""] * len(lines)
@@ -0,0 +1,131 @@
+import threading
+import time
+from concurrent.futures import Future
+from langchain_core.runnables import RunnableLambda
+from src.Databases import TextDatabase, UnifiedDatabase, embed_queries, text_vectors
+
+
+class MicroBatcher:
+    """
+    Coalesces calls made concurrently from several threads into one batched call
+
+    The first caller of a batch waits max_wait seconds for others to join,
+    runs fn on the collected items and hands every caller its own result
+    """
+
+    def __init__(self, fn, max_wait=0.005):
+        self.fn = fn  # list of items -> list of results
+        self.max_wait = max_wait
+        self.lock = threading.Lock()
+        self.pending = []
+
+    def __call__(self, item):
+        future = Future()
+        with self.lock:
+            self.pending.append((item, future))
+            leader = len(self.pending) == 1
+        if leader:
+            time.sleep(self.max_wait)
+            with self.lock:
+                batch, self.pending = self.pending, []
+            try:
+                results = self.fn([i for i, _ in batch])
+                for (_, f), r in zip(batch, results):
+                    f.set_result(r)
+            except Exception as e:
+                for _, f in batch:
+                    f.set_exception(e)
+        return future.result()
+
+
+def limited(model, slots):
+    """
+    Runnable calling model while holding one of slots (a semaphore), all models sharing
+    slots have at most its size calls in flight, whichever thread makes them
+    """
+
+    def invoke(x):
+        with slots:
+            return model.invoke(x)
+
+    return RunnableLambda(invoke)
+
+
+class BatchedDatabase:
+    """
+    Wrapper around a TextDatabase or UnifiedDatabase whose text queries from concurrent
+    threads are embedded as one matrix and searched as one batched query per table
+
+    Image queries and all other attributes go to the wrapped database
+    """
+
+    def __init__(self, vb, max_wait=0.005):
+        self.vb = vb
+        self.batcher = MicroBatcher(self._run, max_wait)
+
+    def __getattr__(self, name):
+        return getattr(self.vb, name)
+
+    def _run(self, items):  # items: list of (question, top_k)
+        texts = []
+        for q, _ in items:
+            if q not in texts:
+                texts.append(q)
+        vectors = embed_queries(self.vb.embedder, texts)
+        results = {}
+        for k in {k for _, k in items}:
+            text_frames = TextDatabase._search(self.vb, vectors, k)
+            if isinstance(self.vb, UnifiedDatabase):
+                image_frames = self.vb.txt_db.query_batch(vectors, k)
+                for t, i_df, t_df in zip(texts, image_frames, text_frames):
+                    results[(t, k)] = {
+                        "image_data": {"image": list(i_df['image_file']), "context": list(i_df['image_context'])},
+                        "text_data": list(t_df['chunk']),
+                        "text_scores": list(t_df['_distance']),
+                        "text_vectors": text_vectors(t_df)
+                    }
+            else:
+                for t, t_df in zip(texts, text_frames):
+                    results[(t, k)] = t_df['chunk']
+        return [results[item] for item in items]
+
+    def query(self, data, top_k=2, where=None):
+        if isinstance(data, str) and where is None:
+            return self.batcher((data, top_k))
+        if where is not None:
+            return self.vb.query(data, top_k, where)
+        return self.vb.query(data, top_k)
+
+    def retriever(self, top_k=2):
+        return RunnableLambda(lambda data: self.query(data, top_k))
+
+
+class BatchedCrossEncoder:
+    """
+    Wrapper around a CrossEncoder whose rank calls from concurrent threads
+    are scored in one batched forward pass
+    """
+
+    def __init__(self, cross_model, max_wait=0.005, batch_size=64):
+        self.cross_model = cross_model
+        self.batch_size = batch_size
+        self.batcher = MicroBatcher(self._run, max_wait)
+
+    def __getattr__(self, name):
+        return getattr(self.cross_model, name)
+
+    def _run(self, items):  # items: list of (query, documents)
+        pairs = [[q, d] for q, docs in items for d in docs]
+        scores = list(self.cross_model.predict(pairs, batch_size=self.batch_size)) if len(pairs) else []
+        results = []
+        for q, docs in items:
+            s, scores = scores[:len(docs)], scores[len(docs):]
+            ranked = [{"corpus_id": i, "score": s[i], "text": d} for i, d in enumerate(docs)]
+            results.append(sorted(ranked, key=lambda x: x['score'], reverse=True))
+        return results
+
+    def rank(self, query, documents, top_k=None, return_documents=False):
+        ranked = self.batcher((query, list(documents)))
+        if not return_documents:
+            ranked = [{k: v for k, v in r.items() if k != 'text'} for r in ranked]
+        return ranked[:top_k]
@@ -0,0 +1,112 @@
+import hashlib
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    Thread-safe least recently used cache
+
+    Bounded by number of entries (max_items) and/or total size (max_bytes, as
+    measured by sizeof), entries older than ttl seconds are never returned
+    """
+
+    def __init__(self, max_items=None, max_bytes=None, ttl=None, sizeof=sys.getsizeof):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sizeof = sizeof
+        self.data = OrderedDict()  # key -> (value, size, expiry)
+        self.lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _remove(self, key):
+        _, size, _ = self.data.pop(key)
+        self.bytes -= size
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key in self.data:
+                value, _, expiry = self.data[key]
+                if expiry is None or expiry > time.monotonic():
+                    self.data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                self._remove(key)
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        size = self.sizeof(value)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        expiry = None if self.ttl is None else time.monotonic() + self.ttl
+        with self.lock:
+            if key in self.data:
+                self._remove(key)
+            self.data[key] = (value, size, expiry)
+            self.bytes += size
+            while ((self.max_items is not None and len(self.data) > self.max_items) or
+                   (self.max_bytes is not None and self.bytes > self.max_bytes)):
+                self._remove(next(iter(self.data)))
+                self.evictions += 1
+
+    def get_or_compute(self, key, fn):
+        """
+        Returns the cached value of key, computing and caching it with fn() on a miss
+        """
+
+        missing = object()
+        value = self.get(key, missing)
+        if value is missing:
+            value = fn()
+            self.put(key, value)
+        return value
+
+    def discard(self, predicate):
+        """
+        Removes the entries whose key satisfies predicate
+        """
+
+        with self.lock:
+            for key in [k for k in self.data if predicate(k)]:
+                self._remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {"entries": len(self.data), "bytes": self.bytes, "hits": self.hits, "misses": self.misses,
+                    "hit_rate": self.hits / lookups if lookups else 0.0, "evictions": self.evictions}
+
+
+def embedder_name(embedder):
+    """
+    Name of an embedding model for cache keys, the same for every instance of the model
+    """
+
+    for attr in ('model_name', 'model_id', 'repo_id'):
+        name = getattr(embedder, attr, None)
+        if isinstance(name, str):
+            return name
+    return type(embedder).__qualname__
+
+
+embeddings = LRUCache(max_items=16384)  # (embedder name, text) -> vector, shared by the agents and RAGEval
+
+
+def image_hash(img):
+    """
+    Content hash of a PIL image (mode, size and pixels)
+    """
+
+    return hashlib.sha256(img.mode.encode() + str(img.size).encode() + img.tobytes()).hexdigest()
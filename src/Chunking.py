@@ -0,0 +1,71 @@
+class StructuredChunker:
+    """
+    Single pass chunker over a stream of (text, page, section) spans
+
+    Chunks never cross a section boundary, except that a short section is kept with its
+    first subsection, so headers are not emitted as chunks of their own. Inside a section the text is packed into
+    chunks of at most chunk_size characters, cut at the last paragraph, line, sentence
+    or word break, and consecutive chunks overlap by about chunk_overlap characters.
+    Only the text of the chunk being built is buffered, so the cost is linear in the
+    document length
+
+    Every chunk is a dict with its text (chunk), the UTF-8 byte offsets of the chunk in
+    the concatenated span texts (start, end), the page it starts on and its section path
+    """
+
+    separators = ('\n\n', '\n', '. ', ' ')
+
+    def __init__(self, chunk_size=1330, chunk_overlap=35):
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+
+    def _cut(self, text):
+        """
+        Length of the next chunk of text, at the last break in its first chunk_size characters
+        """
+
+        window = text[:self.chunk_size]
+        for sep in self.separators:
+            i = window.rfind(sep)
+            if i > self.chunk_size // 2:
+                return i + len(sep)
+        return self.chunk_size
+
+    def split(self, spans):
+        buf, start, marks, section = "", 0, [], None  # marks: (position in buf, page)
+        offset = 0  # byte offset of the end of the spans read
+        for text, page, sec in spans:
+            if sec != section:
+                if section and sec.startswith(section + ' > ') and len(buf.strip()) < self.chunk_size // 4:
+                    section = sec  # a short parent section (e.g. a lone header) opens its first subsection's chunk
+                else:
+                    yield from self._flush(buf, start, marks, section)
+                    buf, start, marks, section = "", offset, [], sec
+            if not marks or marks[-1][1] != page:
+                marks.append((len(buf), page))
+            buf += text
+            offset += len(text.encode('utf-8'))
+            while len(buf) > self.chunk_size:
+                cut = self._cut(buf)
+                yield self._chunk(buf[:cut], start, marks, section)
+                keep = buf[:cut][-self.chunk_overlap:] if self.chunk_overlap else ""
+                if ' ' in keep:  # start the overlap at a word
+                    keep = keep[keep.find(' ') + 1:]
+                shift = cut - len(keep)
+                start += len(buf[:shift].encode('utf-8'))
+                buf = buf[shift:]
+                marks = [(max(p - shift, 0), pg) for p, pg in marks]
+                marks = [m for i, m in enumerate(marks) if i + 1 == len(marks) or marks[i + 1][0] > 0]
+        yield from self._flush(buf, start, marks, section)
+
+    def _flush(self, buf, start, marks, section):
+        if buf.strip():
+            yield self._chunk(buf, start, marks, section)
+
+    @staticmethod
+    def _chunk(text, start, marks, section):
+        chunk = text.strip()
+        start += len(text[:len(text) - len(text.lstrip())].encode('utf-8'))
+        end = start + len(chunk.encode('utf-8'))
+        return {"chunk": chunk, "start": start, "end": end,
+                "page": marks[0][1] if marks else -1, "section": section or ""}
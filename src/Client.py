@@ -0,0 +1,69 @@
+from io import BytesIO
+from urllib.parse import quote
+import requests
+
+
+class RAGClient:
+    """
+    Client for the HTTP service in src/Server.py
+    query() returns the same dictionary as RAGEval.query()
+    """
+
+    def __init__(self, url, timeout=300):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def _post(self, path, **kwargs):
+        response = self.session.post(self.url + path, timeout=self.timeout, **kwargs)
+        response.raise_for_status()
+        return response.json()
+
+    @staticmethod
+    def _headers(profile, request_id):
+        headers = {} if profile is None else {"X-Profile": '1' if profile else '0'}
+        if request_id:
+            headers["X-Request-Id"] = request_id
+        return headers
+
+    def query(self, question, top_k=2, profile=None, request_id=None, document=None):
+        """
+          Returns text and image results for a text question or a PIL image
+          profile asks the server to profile the request (see src/Profiling.py)
+          document restricts the figures returned to those of that pdf
+        """
+
+        headers = self._headers(profile, request_id)
+        if isinstance(question, str):
+            return self._post('/query', json={"question": question, "top_k": top_k, "document": document},
+                              headers=headers)
+        buffered = BytesIO()
+        question.save(buffered, format="PNG")
+        return self._post('/query/image', files={"image": ("image.png", buffered.getvalue(), "image/png")},
+                          data={"top_k": top_k, "document": document}, headers=headers)
+
+    def ingest(self, file_name, content):
+        """
+          Uploads a pdf for ingestion, returns the list of ingested pdfs
+        """
+
+        return self._post('/ingest', files={"pdf": (file_name, content, "application/pdf")})['documents']
+
+    def feedback(self, question, positive, response):
+        return self._post('/feedback', json={"question": question, "positive": positive, "response": response})
+
+    def figure(self, file_name, image, size='original'):
+        """
+          Returns the bytes of a figure of an ingested pdf, size is original, display or thumb
+        """
+
+        response = self.session.get(f"{self.url}/figures/{quote(file_name, safe='')}/{quote(image, safe='')}",
+                                    params={"size": size}, timeout=self.timeout)
+        response.raise_for_status()
+        return response.content
+
+    def ready(self):
+        try:
+            return self.session.get(self.url + '/readyz', timeout=5).status_code == 200
+        except requests.RequestException:
+            return False
@@ -1,41 +1,449 @@
-import torch
-from PIL import Image
-import torchvision.transforms as T
-from datasets import Dataset
 import io
-import pytesseract
+import os
+import re
+import sys
+import json
+import hashlib
+import shutil
 import uuid
 import time
 from abc import ABC, abstractmethod
-import lancedb
+import numpy as np
+import pandas as pd
+import pyarrow as pa
 from langchain_core.runnables import RunnableLambda
+from src.Chunking import StructuredChunker
+from src.Cache import LRUCache
+
+
+def _is_image(data):
+  """
+  True for PIL images, PIL is not imported for it: no image exists before PIL is loaded
+  """
+
+  image = sys.modules.get('PIL.Image')
+  return image is not None and isinstance(data, image.Image)
+
+
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def _fixed_size_list(array, value_type):
+  return pa.FixedSizeListArray.from_arrays(pa.array(array.ravel(), type=value_type), array.shape[1])
+
+
+def _to_numpy(column):
+  """
+  Fixed size list column to a 2D numpy array
+  """
+
+  column = column.combine_chunks()
+  return column.flatten().to_numpy(zero_copy_only=False).reshape(len(column), -1)
+
+
+def text_vectors(df):
+  """
+  Stored vectors of the chunks of a search result, None where the table has no float vectors
+  """
+
+  if 'vector' not in df:
+    return [None] * len(df)
+  return [None if v is None else np.asarray(v, dtype=np.float32) for v in df['vector']]
+
+
+def embed_queries(embedder, texts):
+  """
+  Query vectors of texts, in one batch when the embedder has embed_queries, else one
+  embed_query call per text (embed_documents differs from it for asymmetric embedders)
+  """
+
+  if hasattr(embedder, 'embed_queries'):
+    return embedder.embed_queries(list(texts))
+  return [embedder.embed_query(t) for t in texts]
 
 
 class Database(ABC):
   """
   Base Class for Database Object
+
+  Vector storage (quantization):
+  1. float32: vectors stored as given
+  2. float16: vectors stored as float16, searched by LanceDB
+  3. int8: scalar quantized int8 codes with a per-vector scale
+  4. binary: sign bits packed into bytes with a per-vector scale (mean absolute value)
+  int8 and binary keep no float copy: the compact codes are searched first and the best
+  oversample * top_k candidates are rescored against the decoded vectors (the query
+  itself stays float32). Tables written before by a float16 copy keep it and rescore with it
+
+  Search results are cached process-wide by (table, table version, query vector, top_k,
+  filter), every write bumps the table version so stale results are never served
   """
 
-  def __init__(self, table_name, uri='lancedb/rag'):
+  quantizations = ('float32', 'float16', 'int8', 'binary')
+  oversample = {'int8': 4, 'binary': 16}
+  cache = LRUCache(max_bytes=int(os.getenv('RAG_RETRIEVAL_CACHE_MB', 64)) * 2 ** 20,
+                   sizeof=lambda df: int(df.memory_usage(deep=True).sum()))
+
+  def __init__(self, table_name, uri='lancedb/rag', quantization='float32'):
+    if quantization not in self.quantizations:
+      raise ValueError(f'Quantization should be one of {self.quantizations}')
+    import lancedb  # imported on first use, it takes seconds to load
+
+    self.uri = uri
     self.db = lancedb.connect(uri)
     self.table_name = table_name
+    self.quantization = quantization
+    self._codes = None  # (table version, codes, scales, squared norms)
+
+  def _encode(self, data):
+    """
+    Converts a list of rows with a 'vector' field to an arrow table in the configured storage
+    """
+
+    if self.quantization == 'float32' or not isinstance(data, list) or len(data) == 0:
+      return data
+    vectors = np.asarray([row['vector'] for row in data], dtype=np.float32)
+    table = pa.table({k: [row[k] for row in data] for k in data[0] if k != 'vector'})
+    if self.quantization == 'float16' or Database._has_float_copy(self):
+      table = table.append_column('vector', _fixed_size_list(vectors.astype(np.float16), pa.float16()))
+    if self.quantization == 'int8':
+      scales = np.abs(vectors).max(axis=1) / 127
+      scales[scales == 0] = 1
+      codes = np.round(vectors / scales[:, None]).astype(np.int8)
+      table = table.append_column('qvector', _fixed_size_list(codes, pa.int8()))
+      table = table.append_column('qscale', pa.array(scales.astype(np.float32)))
+    elif self.quantization == 'binary':
+      scales = np.abs(vectors).mean(axis=1)
+      table = table.append_column('qvector', _fixed_size_list(np.packbits(vectors > 0, axis=1), pa.uint8()))
+      table = table.append_column('qscale', pa.array(scales.astype(np.float32)))
+    return table
+
+  def _has_float_copy(self):
+    """
+    True for an existing int8 or binary table written with a float16 copy of the vectors
+    """
+
+    return getattr(self, 'tbl', None) is not None and 'vector' in self.tbl.schema.names
 
   def upsert(self, data):
-    try:  # if table exists
-      self.tbl = self.db.open_table(self.table_name)
-      self.tbl.add(data)
-    except:
+    exists = Database.open(self)
+    data = self._encode(data)
+    if exists:
+      self.tbl.add(self._conform(data))
+    else:
       self.tbl = self.db.create_table(self.table_name, data=data)
+    Database._invalidate(self)
+
+  def _invalidate(self):
+    """
+    Drops the cached results of the table (they would not be served again after a write anyway)
+    """
+
+    table = (self.uri, self.table_name)
+    Database.cache.discard(lambda key: key[:2] == table)
+
+  def _cache_key(self, query_vector, top_k, where):
+    digest = hashlib.blake2b(np.asarray(query_vector, dtype=np.float32).tobytes(), digest_size=16).hexdigest()
+    return self.uri, self.table_name, self.tbl.version, digest, top_k, where
+
+  @staticmethod
+  def cache_stats():
+    return Database.cache.stats()
+
+  def _conform(self, data):
+    """
+    Drops the columns missing from the existing table, e.g. metadata columns added after it was created
+    """
+
+    columns = set(self.tbl.schema.names)
+    if isinstance(data, pa.Table):
+      return data.select([c for c in data.column_names if c in columns])
+    if isinstance(data, list) and len(data) and isinstance(data[0], dict):
+      return [{k: v for k, v in row.items() if k in columns} for row in data]
+    return data
+
+  def query(self, query_str, top_k=2, where=None):
+    """
+    Vector search, where is an optional SQL filter on the table columns applied before the search
+    Filtered searches of int8 and binary tables rescore all the matching rows
+    """
+
+    return Database.query_batch(self, [query_str], top_k, where)[0]
+
+  def _query(self, query_vector, top_k, where):
+    if self.quantization in ('int8', 'binary') and where is None:
+      return Database._rescored_query(self, query_vector, top_k)
+    if self.quantization in ('int8', 'binary') and not Database._has_float_copy(self):
+      rows = self.tbl.to_lance().to_table(filter=where).to_pandas()
+      return Database._rescore(self, rows, query_vector, top_k)
+    return Database._search_query(self, query_vector, where).limit(top_k).to_pandas()
+
+  def _search_query(self, query, where=None):
+    search = self.tbl.search(query, vector_column_name='vector')
+    return search if where is None else search.where(where, prefilter=True)
+
+  def query_batch(self, query_vectors, top_k=2, where=None):
+    """
+    Vector search for several query vectors in one scan, returns a dataframe per vector
+    Only the vectors without a cached result are searched
+    """
+
+    keys = [Database._cache_key(self, v, top_k, where) for v in query_vectors]
+    frames = [Database.cache.get(k) for k in keys]
+    missing = [i for i, f in enumerate(frames) if f is None]
+    vectors = [query_vectors[i] for i in missing]
+    if len(vectors) == 1 or self.quantization in ('int8', 'binary'):
+      found = [Database._query(self, v, top_k, where) for v in vectors]
+    elif vectors:
+      df = Database._search_query(self, list(vectors), where).limit(top_k).to_pandas()
+      found = [df[df['query_index'] == i].drop(columns='query_index').reset_index(drop=True)
+               for i in range(len(vectors))]
+    else:
+      found = []
+    for i, df in zip(missing, found):
+      Database.cache.put(keys[i], df)
+      frames[i] = df
+    return [f.copy() for f in frames]
+
+  def _load_codes(self):
+    """
+    Quantized codes of the table, kept in memory until the table version changes
+    """
+
+    version = self.tbl.version
+    if self._codes is None or self._codes[0] != version:
+      columns = ['qvector', 'qscale'] if self.quantization == 'int8' else ['qvector']
+      table = self.tbl.to_lance().to_table(columns=columns)
+      codes = _to_numpy(table['qvector'])
+      if self.quantization == 'int8':
+        scales = table['qscale'].to_numpy()
+        norms = scales ** 2 * (codes.astype(np.float32) ** 2).sum(axis=1)
+      else:
+        scales, norms = None, None
+      self._codes = (version, codes, scales, norms)
+    return self._codes[1:]
+
+  def _candidates(self, query_vector, n):
+    """
+    Positions of the n nearest rows by the quantized codes
+    """
+
+    q = np.asarray(query_vector, dtype=np.float32)
+    codes, scales, norms = Database._load_codes(self)
+    if self.quantization == 'int8':
+      approx = norms - 2 * scales * (codes @ q)  # squared L2 up to the constant |q|^2
+    else:
+      approx = _POPCOUNT[codes ^ np.packbits(q > 0)].sum(axis=1)  # hamming distance
+    if n >= len(approx):
+      return np.arange(len(approx))
+    return np.argpartition(approx, n - 1)[:n]
 
-  def query(self, query_str, top_k=2):
-    return self.tbl.search(query_str).limit(top_k).to_pandas()
+  def _rescored_query(self, query_vector, top_k):
+    """
+    Quantized first pass followed by rescoring of the candidates
+    """
+
+    q = np.asarray(query_vector, dtype=np.float32)
+    positions = Database._candidates(self, q, top_k * self.oversample[self.quantization])
+    rows = self.tbl.to_lance().take(positions.tolist()).to_pandas()
+    return Database._rescore(self, rows, q, top_k)
+
+  def _decode(self, rows, dim):
+    """
+    Float32 vectors of the rows, the stored float16 copy when there is one, else
+    decoded from the codes: codes * scale for int8, scale * (+1/-1 per bit) for binary
+    """
+
+    if 'vector' in rows:
+      return np.stack(rows['vector'].to_numpy()).astype(np.float32)
+    codes = np.stack(rows['qvector'].to_numpy())
+    scales = rows['qscale'].to_numpy(dtype=np.float32)[:, None]
+    if self.quantization == 'int8':
+      return codes.astype(np.float32) * scales
+    return (np.unpackbits(codes, axis=1, count=dim).astype(np.float32) * 2 - 1) * scales
+
+  def _rescore(self, rows, query_vector, top_k):
+    """
+    The top_k rows nearest to the query by their decoded vectors, int8 results carry them
+    as 'vector' (binary ones are too coarse to stand for the embedding)
+    """
+
+    q = np.asarray(query_vector, dtype=np.float32)
+    if len(rows) == 0:
+      return rows.drop(columns=['qvector', 'qscale'], errors='ignore').assign(_distance=[])
+    vectors = Database._decode(self, rows, len(q))
+    distances = ((vectors - q) ** 2).sum(axis=1)
+    order = np.argsort(distances)[:top_k]
+    df = rows.iloc[order].drop(columns=['qvector', 'qscale'], errors='ignore').reset_index(drop=True)
+    if self.quantization == 'int8' and 'vector' not in df:
+      df['vector'] = list(vectors[order])
+    df['_distance'] = distances[order]
+    return df
+
+  def storage_stats(self):
+    """
+    Rows, bytes of stored vector columns and bytes scanned by the first search pass
+    """
+
+    table = self.tbl.to_lance().to_table()
+    vector_bytes = sum(table[c].nbytes for c in ('vector', 'qvector', 'qscale') if c in table.column_names)
+    scan_bytes = table['qvector'].nbytes if 'qvector' in table.column_names else table['vector'].nbytes
+    return {"rows": table.num_rows, "vector_bytes": vector_bytes, "scan_bytes": scan_bytes}
+
+  def measure_recall(self, query_vectors, top_k=10, vectors=None):
+    """
+    Recall@top_k of the quantized first pass and of the rescored search, against exact
+    search over vectors, the original vectors in table order (by default the stored float
+    vectors, int8 and binary tables have none)
+    """
+
+    if vectors is None:
+      if 'vector' not in self.tbl.schema.names:
+        raise ValueError(f'{self.table_name} stores no float vectors, pass the original vectors')
+      vectors = _to_numpy(self.tbl.to_lance().to_table(columns=['vector'])['vector'])
+    vectors = np.asarray(vectors, dtype=np.float32)
+    quantized = self.quantization in ('int8', 'binary')
+    if quantized:
+      stored = Database._decode(self, self.tbl.to_lance().to_table().to_pandas(), vectors.shape[1])
+    else:
+      stored = _to_numpy(self.tbl.to_lance().to_table(columns=['vector'])['vector']).astype(np.float32)
+    first, rescored = [], []
+    for q in query_vectors:
+      q = np.asarray(q, dtype=np.float32)
+      exact = set(np.argsort(((vectors - q) ** 2).sum(axis=1))[:top_k].tolist())
+      if quantized:
+        candidates = Database._candidates(self, q, top_k * self.oversample[self.quantization])
+        first.append(len(exact & set(Database._candidates(self, q, top_k).tolist())) / len(exact))
+      else:
+        candidates = np.arange(len(stored))
+      best = candidates[np.argsort(((stored[candidates] - q) ** 2).sum(axis=1))[:top_k]]
+      rescored.append(len(exact & set(best.tolist())) / len(exact))
+      if not quantized:
+        first.append(rescored[-1])
+    return {"first_pass": float(np.mean(first)), "rescored": float(np.mean(rescored))}
+
+  def open(self):
+    """
+    Opens the existing table, returns False if it does not exist yet
+    """
+
+    try:
+      self.tbl = self.db.open_table(self.table_name)
+      return True
+    except (FileNotFoundError, ValueError):
+      return False
+
+  def compact(self, key):
+    """
+    Removes rows duplicating an earlier row's key column and rewrites the table
+    """
+
+    table = self.tbl.to_arrow()
+    keep = ~table[key].to_pandas().duplicated()
+    if not keep.all():
+      self.tbl = self.db.create_table(self.table_name, data=table.filter(pa.array(keep.to_numpy())), mode='overwrite')
+      Database._invalidate(self)
 
   def delete(self):
     self.db.drop_table(self.table_name)
+    Database._invalidate(self)
+
+  def export(self, directory):
+    """
+    Copies the Lance files of the table to directory, returns {table name: table version}
+    """
+
+    shutil.copytree(os.path.join(self.uri, self.table_name + '.lance'),
+                    os.path.join(directory, self.table_name + '.lance'), dirs_exist_ok=True)
+    return {self.table_name: self.tbl.version}
 
   def is_empty(self):
     return self.tbl.count_rows() == 0
 
+  def version(self):
+    """
+    Version of the table, bumped by every write
+    """
+
+    return self.tbl.version
+
+  def versions(self):
+    """
+    {table name: table version} of the tables of the store, as export returns them
+    """
+
+    return {self.table_name: self.tbl.version}
+
+
+class FigureIndex:
+  """
+  Document -> normalized figure label -> image_file dictionaries, persisted as JSON next
+  to the _img table. Labels are kept per document, 'Figure 1' of every pdf is indexed
+  """
+
+  pattern = re.compile(r'\bfig(?:ure)?\.?\s*(\d+(?:[.\-]\d+)*)', flags=re.IGNORECASE)
+
+  def __init__(self, path):
+    self.path = path
+    self.labels = {}
+    if os.path.exists(path):
+      with open(path) as f:
+        self.labels = json.load(f)
+      if any(isinstance(v, str) for v in self.labels.values()):  # single label dictionary of older indexes
+        self.labels = {"": self.labels}
+
+  @classmethod
+  def normalize(cls, text):
+    """
+    Figure labels mentioned in a text, e.g. 'see Fig. 3-2' -> ['figure 3.2']
+    """
+
+    return ['figure ' + n.replace('-', '.') for n in cls.pattern.findall(text)]
+
+  def add(self, image_file, document=None):
+    """
+    Indexes an image of document by the figure labels of its file name (the figure caption)
+    """
+
+    caption = image_file[:-4] if image_file.endswith('.png') else image_file
+    labels = self.labels.setdefault(document or "", {})
+    for label in self.normalize(caption) + [" ".join(caption.lower().split())]:
+      labels.setdefault(label, image_file)
+
+  def lookup(self, text, document=None):
+    """
+    Images of the figures labelled in text, in the given document or in every document
+    """
+
+    indexes = [self._labels(document)] if document is not None else list(self.labels.values())
+    images = []
+    for label in self.normalize(text) + [" ".join(text.lower().split())]:
+      for labels in indexes:
+        if label in labels and labels[label] not in images:
+          images.append(labels[label])
+    return images
+
+  def files(self, document):
+    """
+    Image files indexed for document
+    """
+
+    return set(self._labels(document).values())
+
+  def _labels(self, document):
+    # indexes migrated from the single dictionary format keep their labels under ""
+    return self.labels.get(document, self.labels.get("", {}))
+
+  def clear(self):
+    self.labels = {}
+    if os.path.exists(self.path):
+      os.remove(self.path)
+
+  def save(self):
+    with open(self.path + '.tmp', 'w') as f:
+      json.dump(self.labels, f)
+    os.replace(self.path + '.tmp', self.path)
+
 
 class ImageDatabase(Database):
   """
@@ -45,15 +453,20 @@ class ImageDatabase(Database):
 
   top_k = 2
 
-  def __init__(self, table_name, uri):
-    self.im_db = Database(table_name + '_img', uri)
-    self.txt_db = Database(table_name + '_txt', uri)
+  def __init__(self, table_name, uri, quantization='float32'):
+    self.im_db = Database(table_name + '_img', uri, quantization)
+    self.txt_db = Database(table_name + '_txt', uri, quantization)
+    self.figure_index = FigureIndex(os.path.join(uri, table_name + '_img.figures.json'))
 
   def image_model_prep(self, extractor, model):
     """
     Preparation of Chain for Image-to-Vector Conversion
+    torch and torchvision are only loaded here, text-only stores never import them
     """
 
+    import torch
+    import torchvision.transforms as T
+
     self.extractor = extractor
     self.model = model
     self.device = "cuda" if torch.cuda.is_available() else "cpu"
@@ -77,6 +490,8 @@ class ImageDatabase(Database):
     Get the embedding for image
     """
 
+    import torch
+
     image_transformed = self.transformation_chain(image).unsqueeze(0)
     new_batch = {"pixel_values": image_transformed.to(self.device)}
     with torch.no_grad():
@@ -90,7 +505,11 @@ class ImageDatabase(Database):
 
     return self.embedder.embed_query(text)
 
-  def upsert(self, data):  # image_file_name, image_context, PIL Object
+  def upsert(self, data, document=None):  # image_file_name, image_context, PIL Object
+    """
+    document (the pdf the images come from) keys their figure labels, see FigureIndex
+    """
+
     if isinstance(data, list) and all(isinstance(i, tuple) and len(i) == 3 for i in data):
       image_embeddings = [{"image_file": i[0], "image_context": i[1], "vector": self._get_image_embedding(i[2])} for i
                           in data]
@@ -106,73 +525,242 @@ class ImageDatabase(Database):
 
     self.im_db.upsert(image_embeddings)
     self.txt_db.upsert(text_embeddings)
+    for i in image_embeddings:
+      self.figure_index.add(i['image_file'], document)
+    self.figure_index.save()
 
   def query(self, data, top_k=2):
-    self.top_k = top_k
-    if isinstance(data, Image.Image):  # image 2 image
+    if _is_image(data):  # image 2 image
       image_embedding = self._get_image_embedding(data)
-      result = self.im_db.query(image_embedding, self.top_k)  # image + text
+      result = self.im_db.query(image_embedding, top_k)  # image + text
     elif isinstance(data, str):  # text 2 image
       text_embedding = self._get_text_embedding(data)
-      result = self.txt_db.query(text_embedding, self.top_k)  # image + text
+      result = self.txt_db.query(text_embedding, top_k)  # image + text
     else:
       raise TypeError('Data has to be a string or an PIL Image')
     return {"image": list(result['image_file']), "context": list(result['image_context'])}
 
+  def open(self):
+    return self.im_db.open() and self.txt_db.open()
+
   def delete(self):
     self.im_db.delete()
     self.txt_db.delete()
+    self.figure_index.clear()
+
+  def export(self, directory):
+    """
+    Copies the image tables and the figure index to directory
+    """
+
+    versions = self.im_db.export(directory)
+    versions.update(self.txt_db.export(directory))
+    if os.path.exists(self.figure_index.path):
+      shutil.copy2(self.figure_index.path, directory)
+    return versions
+
+  def versions(self):
+    versions = self.im_db.versions()
+    versions.update(self.txt_db.versions())
+    return versions
 
   def is_empty(self):
     return self.im_db.is_empty() and self.txt_db.is_empty()
 
+  def image_version(self):
+    """
+    Versions of the image tables, changed by every image write
+    """
+
+    return self.im_db.version(), self.txt_db.version()
+
   def retriever(self, top_k=2):
-    self.top_k = top_k
-    return RunnableLambda(self.query)
+    return RunnableLambda(lambda data: self.query(data, top_k))
+
+  def search_name(self, name, document=None):
+      """
+      Image closest to name by its context, only kept if it belongs to document when given
+      """
 
-  def search_name(self, name):
       embed = self._get_text_embedding(name)
-      print(name)
-      df = self.txt_db.tbl.search(embed, 'vector'
-      ).limit(1).to_pandas()
+      df = self.txt_db.query(embed, 1)
+      if document is not None:
+        df = df[df['image_file'].isin(self.figure_index.files(document))]
       return df
 
+  def find_figure(self, name, document=None):
+    """
+    Images of the figures labelled in name, by exact lookup of the normalized label,
+    in document or in all ingested documents
+    """
+
+    return self.figure_index.lookup(name, document)
+
 
 class TextDatabase(Database):
-  top_k = 2
+  """
+  Chunk table with columns chunk, vector, start, end (byte offsets in the document text),
+  page and section (header path), the metadata columns can be filtered on with where
 
-  def __init__(self, table_name, uri):
-    super().__init__(table_name, uri)
+  With the small-to-big index (model_prep child_size) the chunks also have an id, and a
+  <table>_children table holds their embedded sentence windows
+  """
 
-  def model_prep(self, embedder, splitter):
+  top_k = 2
+  embed_batch = 64  # chunks embedded per embed_documents call
+  child_fanout = 4  # children searched per parent returned
+  window_pad = 200  # characters of the parent kept around the matched children
+  sentence = re.compile(r'(?<=[.!?])\s+|\n+')
+
+  def __init__(self, table_name, uri, quantization='float32'):
+    super().__init__(table_name, uri, quantization)
+    self.children = Database(table_name + '_children', uri, quantization)
+    self.child_size = 0
+    self._small_to_big = None  # if the children table exists, checked on first search
+
+  def model_prep(self, embedder, splitter, child_size=0):
     """
     Set up embedder and text splitter
+    The chunker takes its chunk size and overlap from the splitter
+
+    child_size > 0 builds the small-to-big index: every chunk (parent) is also split into
+    sentence windows of about child_size characters (children) that are embedded and searched
+    in place of the parents, see _search
     """
 
     self.embedder = embedder
     self.splitter = splitter
+    self.chunker = StructuredChunker(getattr(splitter, '_chunk_size', 1330), getattr(splitter, '_chunk_overlap', 35))
+    self.child_size = child_size
+
+  def upsert(self, data):
+    """
+    data is a str, or an iterable of (text, page, section) spans (see Ingestion.document_spans)
+    """
 
-  def upsert(self, data):  # data is str
     if isinstance(data, str):
-      chunks = self.splitter.split_documents(self.splitter.create_documents(self.splitter.split_text(data)))
-      chunks = [c.page_content for c in chunks]
-      chunk_embeddings = [{"chunk": chunk, "vector": self.embedder.embed_documents(chunk)} for chunk in chunks]
-      super().upsert(chunk_embeddings)
-    else:
-      raise TypeError("Data should be a string")
+      data = [(data, -1, "")]
+    elif not hasattr(data, '__iter__'):
+      raise TypeError("Data should be a string or an iterable of (text, page, section) spans")
+    batch = []
+    for chunk in self.chunker.split(data):
+      batch.append(chunk)
+      if len(batch) == self.embed_batch:
+        self._insert(batch)
+        batch = []
+    if batch:
+      self._insert(batch)
+
+  def _insert(self, chunks):
+    if self.child_size:
+      chunks = [dict(c, id=uuid.uuid4().hex) for c in chunks]
+    vectors = self.embedder.embed_documents([c['chunk'] for c in chunks])
+    Database.upsert(self, [dict(c, vector=v) for c, v in zip(chunks, vectors)])
+    if self.child_size and 'id' in self.tbl.schema.names:  # tables made before the index have no parent ids
+      children = [child for c in chunks for child in self._children(c)]
+      vectors = self.embedder.embed_documents([c['chunk'] for c in children])
+      self.children.upsert([dict(c, vector=v) for c, v in zip(children, vectors)])
+      self._small_to_big = True
+
+  def _children(self, parent):
+    """
+    Sentence windows of about child_size characters of a parent chunk, with their character offset in it
+    """
 
-  def query(self, data, top_k=2): # str
-    self.top_k = top_k
+    text, children, begin = parent['chunk'], [], 0
+    ends = [m.start() for m in self.sentence.finditer(text)] + [len(text)]
+    for i, end in enumerate(ends):
+      if end - begin >= self.child_size or i + 1 == len(ends):
+        window = text[begin:end].strip()
+        if window:
+          offset = begin + text[begin:end].find(window)
+          children.append({"chunk": window, "parent": parent['id'], "offset": offset, "length": len(window),
+                           "page": parent['page'], "section": parent['section']})
+        begin = end
+    return children
+
+  def query(self, data, top_k=2, where=None): # str
     embedding = self.embedder.embed_query(data)
-    return super().query(embedding, self.top_k)['chunk']  # text
+    return self._search([embedding], top_k, where)[0]['chunk']  # text
+
+  def search_many(self, texts, top_k=2, where=None):
+    """
+    Chunk search for several texts at once, embedded as queries (see embed_queries), returns a dataframe
+    (chunk, _distance, ...) per text
+    """
+
+    return self._search(embed_queries(self.embedder, texts), top_k, where)
+
+  def _search(self, query_vectors, top_k, where=None):
+    """
+    Chunk search for a batch of query vectors, returns a dataframe per vector
+
+    With the small-to-big index, the children are searched and the chunks returned are
+    the windows of the top_k best parents around their matched children (window_pad
+    characters on each side), _distance is that of the parent's best child
+    """
+
+    if self._small_to_big is None:
+      self._small_to_big = self.children.open()
+    if not self._small_to_big:
+      return Database.query_batch(self, query_vectors, top_k, where)
+    frames = Database.query_batch(self.children, query_vectors, top_k * self.child_fanout, where)
+    ids = {p for df in frames for p in df['parent']}
+    if not ids:
+      return [df.reindex(columns=['chunk', '_distance', 'vector', 'page', 'section']) for df in frames]
+    listed = ", ".join(f"'{i}'" for i in ids)
+    parents = self.tbl.to_lance().to_table(columns=['id', 'chunk', 'start', 'end', 'page', 'section'],
+                                           filter=f"id IN ({listed})").to_pandas().set_index('id')
+    results = []
+    for df in frames:
+      df = df[df['parent'].isin(parents.index)]
+      best = df.groupby('parent', sort=False)['_distance'].min().nsmallest(top_k)
+      rows = []
+      for parent_id, distance in best.items():
+        hits = df[df['parent'] == parent_id]
+        parent = parents.loc[parent_id]
+        lo = max(int(hits['offset'].min()) - self.window_pad, 0)
+        hi = int((hits['offset'] + hits['length']).max()) + self.window_pad
+        text = parent['chunk']
+        if lo > 0 and ' ' in text[lo:lo + self.window_pad]:  # cut the window at words
+          lo = text.index(' ', lo) + 1
+        if hi < len(text) and ' ' in text[hi - self.window_pad:hi]:
+          hi = text.rindex(' ', 0, hi)
+        vector = hits.loc[hits['_distance'].idxmin(), 'vector'] if 'vector' in hits else None  # best child's
+        rows.append({"chunk": text[lo:hi], "_distance": distance, "vector": vector, "parent": parent_id,
+                     "page": parent['page'], "section": parent['section']})
+      results.append(pd.DataFrame(rows, columns=['chunk', '_distance', 'vector', 'parent', 'page', 'section']))
+    return results
+
+  def delete(self):
+    Database.delete(self)
+    if self._small_to_big or self.children.open():
+      self.children.delete()
+    self._small_to_big = None
+
+  def export(self, directory):
+    """
+    Copies the chunk table and its small-to-big children table, if any, to directory
+    """
+
+    versions = Database.export(self, directory)
+    if self._small_to_big or self.children.open():
+      versions.update(self.children.export(directory))
+    return versions
+
+  def versions(self):
+    versions = Database.versions(self)
+    if self._small_to_big or self.children.open():
+      versions.update(self.children.versions())
+    return versions
 
   def retriever(self, top_k):
     """
-    Set up RunnableLambda retriever (for rag-graph usage)
+    Set up RunnableLambda retriever (for rag-graph usage), the store is shared between
+    requests, top_k is bound to the retriever, not kept on the store
     """
 
-    self.top_k = top_k
-    return RunnableLambda(self.query)
+    return RunnableLambda(lambda data: self.query(data, top_k))
 
 
 class UnifiedDatabase(ImageDatabase, TextDatabase):
@@ -180,41 +768,63 @@ class UnifiedDatabase(ImageDatabase, TextDatabase):
   Database with both Image and Text Database interface
   """
 
-  def __init__(self, table_name, uri):
+  def __init__(self, table_name, uri, quantization='float32'):
     self.im_table_name = table_name + '_image'
     self.txt_table_name = table_name + '_text'
-    ImageDatabase.__init__(self, self.im_table_name, uri)
-    TextDatabase.__init__(self, self.txt_table_name, uri)
+    ImageDatabase.__init__(self, self.im_table_name, uri, quantization)
+    TextDatabase.__init__(self, self.txt_table_name, uri, quantization)
 
-  def model_prep(self, extractor, model, embedder, splitter):
+  def model_prep(self, extractor, model, embedder, splitter, child_size=0):
     """
     Setup of models for extraction
     """
 
     ImageDatabase.image_model_prep(self, extractor, model)
     ImageDatabase.text_model_prep(self, embedder)
-    TextDatabase.model_prep(self, embedder, splitter)
+    TextDatabase.model_prep(self, embedder, splitter, child_size)
 
-  def upsert(self, data):
-    if isinstance(data, str):  # text
+  def upsert(self, data, document=None):
+    if isinstance(data, list) and len(data) and isinstance(data[0], tuple) and _is_image(data[0][-1]):  # image
+      ImageDatabase.upsert(self, data, document)
+    elif isinstance(data, str) or hasattr(data, '__iter__'):  # text or text spans
       TextDatabase.upsert(self, data)
-    elif isinstance(data, list) and isinstance(data[0], tuple):  # image
-      ImageDatabase.upsert(self, data)
 
-  def query(self, data, top_k=2):  # image, text
+  def query(self, data, top_k=2, where=None):  # image, text
+    """
+    where filters the text chunks, see TextDatabase
+    """
+
     if isinstance(data, str):  # text
       image_data = ImageDatabase.query(self, data, top_k)  # image, text
-      text_data = TextDatabase.query(self, data, top_k)  # text
-      return {"image_data": image_data, "text_data": list(text_data)}
-    elif isinstance(data, Image.Image):  # image
+      text_df = self._search([self.embedder.embed_query(data)], top_k, where)[0]  # text
+      return {"image_data": image_data, "text_data": list(text_df['chunk']), "text_scores": list(text_df['_distance']),
+              "text_vectors": text_vectors(text_df)}
+    elif _is_image(data):  # image
       image_data = ImageDatabase.query(self, data, top_k)  # dict[list, list]
-      return {"image_data": image_data, "text_data": []}
+      return {"image_data": image_data, "text_data": [], "text_scores": [], "text_vectors": []}
     else:
       raise TypeError('Data has to be a string or an PIL Image')
 
+  def open(self):
+    return ImageDatabase.open(self) and Database.open(self)
+
   def delete(self):
     ImageDatabase.delete(self)
     TextDatabase.delete(self)  # Uncomment if TextDatabase is defined
 
+  def export(self, directory):
+    """
+    Copies all tables of the store to directory, see Snapshot for whole bundles
+    """
+
+    versions = ImageDatabase.export(self, directory)
+    versions.update(TextDatabase.export(self, directory))
+    return versions
+
+  def versions(self):
+    versions = ImageDatabase.versions(self)
+    versions.update(TextDatabase.versions(self))
+    return versions
+
   def is_empty(self):
     return ImageDatabase.is_empty(self) and TextDatabase.is_empty(self)  # Uncomment if TextDatabase is defined
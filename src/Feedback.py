@@ -0,0 +1,94 @@
+import fcntl
+import json
+import os
+import time
+import uuid
+
+
+class FeedbackJournal:
+    """
+    Append-only, fsync'd feedback log (one JSON record per line)
+
+    A checkpoint file next to the journal stores the byte offset up to which records
+    have been embedded into the feedback table, so sync() only embeds new records.
+    The legacy feedback_loop.txt is imported once, and the table is deduplicated
+    every compact_every synced records
+    """
+
+    compact_every = 50
+
+    def __init__(self, path='./feedback_journal.jsonl', legacy_file='./feedback_loop.txt'):
+        self.path = path
+        self.checkpoint = path + '.offset'
+        self.legacy_file = legacy_file
+
+    @staticmethod
+    def record(question, positive, response):
+        """
+        Feedback text in the format parsed by the feedback nodes of RAGEval
+        """
+
+        return f"The feedback for {question} is {'POSITIVE ' if positive else 'NEGATIVE '} and the response is {response}"
+
+    def append(self, text):
+        line = json.dumps({"id": uuid.uuid4().hex, "time": time.time(), "text": text}) + '\n'
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line.encode('utf-8'))
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _state(self):
+        if not os.path.exists(self.checkpoint):
+            return {"offset": 0, "since_compaction": 0, "legacy": False}
+        with open(self.checkpoint) as f:
+            return json.load(f)
+
+    def _save_state(self, state):
+        with open(self.checkpoint + '.tmp', 'w') as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.checkpoint + '.tmp', self.checkpoint)
+
+    def _new_records(self, offset):
+        """
+        Texts of the complete records after offset and the offset after them
+        """
+
+        if not os.path.exists(self.path):
+            return [], offset
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            data = f.read()
+        end = data.rfind(b'\n') + 1  # a partially written last line is left for the next sync
+        texts = [json.loads(l)['text'] for l in data[:end].decode('utf-8').splitlines() if l.strip()]
+        return texts, offset + end
+
+    def sync(self, db):
+        """
+        Embeds and inserts the records not yet in db (a TextDatabase), returns how many
+        """
+
+        with open(self.checkpoint + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            state = self._state()
+            if not db.open():  # table missing, index the whole journal again
+                state = {"offset": 0, "since_compaction": 0, "legacy": False}
+            texts = []
+            if not state['legacy'] and self.legacy_file and os.path.exists(self.legacy_file):
+                with open(self.legacy_file) as f:
+                    texts.append(f.read())
+            state['legacy'] = True
+            new, state['offset'] = self._new_records(state['offset'])
+            texts += new
+            texts = [t for t in texts if len(t.strip()) != 0]
+            for text in texts:
+                db.upsert(text)
+            state['since_compaction'] += len(texts)
+            if state['since_compaction'] >= self.compact_every:
+                db.compact('chunk')
+                state['since_compaction'] = 0
+            self._save_state(state)
+        return len(texts)
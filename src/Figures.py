@@ -0,0 +1,72 @@
+import os
+from io import BytesIO
+from PIL import Image
+from src.Cache import LRUCache
+
+# derivative name -> longest side in pixels
+DERIVATIVES = {"thumb": 256, "display": 1024}
+
+
+def derivative_path(image_folder, image, size):
+    return os.path.join(image_folder, size, os.path.splitext(image)[0] + '.webp')
+
+
+def write_derivatives(image_folder):
+    """
+    Writes a WebP thumbnail and display-size copy of every figure in image_folder
+    to image_folder/thumb and image_folder/display
+    """
+
+    for size in DERIVATIVES:
+        os.makedirs(os.path.join(image_folder, size), exist_ok=True)
+    for image in os.listdir(image_folder):
+        if not image.endswith('.png'):
+            continue
+        with Image.open(os.path.join(image_folder, image)) as im:
+            im = im.convert('RGBA' if 'A' in im.getbands() else 'RGB')
+            for size, side in DERIVATIVES.items():
+                d = im.copy()
+                d.thumbnail((side, side))
+                d.save(derivative_path(image_folder, image, size), format='WEBP', quality=80, method=4)
+
+
+def read_figure(file_name, image, size='display'):
+    """
+    Bytes of a figure of figures_<file_name>, the original when no derivative exists
+    """
+
+    image_folder = os.path.join(os.getcwd(), f'figures_{file_name}')
+    path = derivative_path(image_folder, image, size) if size in DERIVATIVES else None
+    if path is None or not os.path.exists(path):
+        path = os.path.join(image_folder, image)
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+class FigureCache:
+    """
+    In-memory LRU of encoded figures keyed by (file, image, size)
+    loader(file_name, image, size) returns the bytes on a miss
+    """
+
+    def __init__(self, loader=read_figure, max_bytes=64 * 2 ** 20):
+        self.loader = loader
+        self.cache = LRUCache(max_bytes=max_bytes, sizeof=len)
+
+    def get(self, file_name, image, size='display'):
+        return self.cache.get_or_compute((file_name, image, size), lambda: self.loader(file_name, image, size))
+
+    def montage(self, file_name, images, top_k=5, columns=3):
+        """
+        PNG grid of the thumbnails of up to top_k images
+        """
+
+        thumbs = [Image.open(BytesIO(self.get(file_name, i, 'thumb'))) for i in images[:top_k]]
+        side = DERIVATIVES['thumb']
+        rows = max(1, (len(thumbs) + columns - 1) // columns)
+        grid = Image.new('RGB', (columns * side, rows * side), 'white')
+        for n, t in enumerate(thumbs):
+            grid.paste(t.convert('RGB'), ((n % columns) * side, (n // columns) * side))
+        buffered = BytesIO()
+        grid.save(buffered, format='PNG')
+        return buffered.getvalue()
@@ -0,0 +1,254 @@
+import re
+import os
+import json
+import spire.pdf
+import fitz
+from PIL import Image
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from src.Databases import UnifiedDatabase
+from src.Figures import write_derivatives
+from src.Profiling import profiled
+
+
+def data_prep(file_name):
+    """
+    Extracts the figures with their contexts from pdfs/<file_name>, the text is read by
+    document_spans. Figures are written to figures_<file_name>
+    """
+
+    def findWholeWord(w):
+        return re.compile(r'\b{0}\b'.format(re.escape(w)), flags=re.IGNORECASE).search
+
+    pdf_file_path = os.path.join(os.getcwd(), 'pdfs', file_name)
+    image_folder = os.path.join(os.getcwd(), f'figures_{file_name}')
+    if not os.path.exists(image_folder):
+        os.makedirs(image_folder)
+
+    # everything down here is wrt pages dir
+    print('1. folder made')
+    with spire.pdf.PdfDocument() as doc:
+        doc.LoadFromFile(pdf_file_path)
+        images = []
+        for page_num in range(doc.Pages.Count):
+            page = doc.Pages[page_num]
+            for image_num in range(len(page.ImagesInfo)):
+                imageFileName = os.path.join(image_folder, f'figure-{page_num}-{image_num}.png')
+                image = page.ImagesInfo[image_num]
+                image.Image.Save(imageFileName)
+                images.append({
+                    "image_file_name": imageFileName,
+                    "image": image
+                })
+    print('2. image extraction done')
+    image_info = []
+    for image_file in os.listdir(image_folder):
+        if image_file.endswith('.png'):
+            image_info.append({
+                "image_file_name": image_file[:-4],
+                "image": Image.open(os.path.join(image_folder, image_file)),
+                "pg_no": int(image_file.split('-')[1])
+            })
+    print('3. temporary')
+    figures = []
+    with fitz.open(pdf_file_path) as pdf_file:
+        hs = []
+        for i in image_info:
+            src = i['image_file_name'] + '.png'
+            headers = {'_': []}
+            header = '_'
+            page = pdf_file[i['pg_no']]
+            texts = page.get_text('dict')
+            for block in texts['blocks']:
+                if block['type'] == 0:
+                    for line in block['lines']:
+                        for span in line['spans']:
+                            if 'bol' in span['font'].lower() and not span['text'].isnumeric():
+                                header = span['text']
+                                print("header: ", header)
+                                headers[header] = [header]
+                            else:
+                                headers[header].append(span['text'])
+                            try:
+                                if findWholeWord('fig')(span['text']):
+                                    i['image_file_name'] = span['text']
+                                    figures.append(span['text'].split('fig')[-1])
+                                elif findWholeWord('figure')(span['text']):
+                                    i['image_file_name'] = span['text']
+                                    figures.append(span['text'].lower().split('figure')[-1])
+                                else:
+                                    pass
+                            except re.error:
+                                pass
+            if not i['image_file_name'].endswith('.png'):
+                s = i['image_file_name'] + '.png'
+                i['image_file_name'] = s
+                os.rename(os.path.join(image_folder, src), os.path.join(image_folder, i['image_file_name']))
+            hs.append({"image": i, "header": headers})
+        print('4. header and figures done')
+        figure_contexts = {}
+        for fig in figures:
+            figure_contexts[fig] = []
+            for page_num in range(len(pdf_file)):
+                page = pdf_file[page_num]
+                texts = page.get_text('dict')
+                for block in texts['blocks']:
+                    if block['type'] == 0:
+                        for line in block['lines']:
+                            for span in line['spans']:
+                                if findWholeWord(fig)(span['text']):
+                                    print('figure mention: ', span['text'])
+                                    figure_contexts[fig].append(span['text'])
+        print('5. Figure context collected')
+        import pytesseract  # OCR of the figures, loaded on the first ingestion
+
+        contexts = []
+        for h in hs:
+            context = ""
+            for q in h['header'].values():
+                context += "".join(q)
+            s = pytesseract.image_to_string(h['image']['image'])
+            qwea = context + '\n' + s if len(s) != 0 else context
+            contexts.append((
+                h['image']['image_file_name'],
+                qwea,
+                h['image']['image']
+            ))
+        print('6. Overall context collected')
+        image_content = []
+        for fig in figure_contexts:
+            for c in contexts:
+                if findWholeWord(fig)(c[0]):
+                    s = c[1] + '\n' + "\n".join(figure_contexts[fig])
+                    s = str("\n".join(
+                        [
+                            "".join([h for h in i.strip() if h.isprintable()])
+                            for i in s.split('\n')
+                            if len(i.strip()) != 0
+                        ]
+                    ))
+                    image_content.append((
+                        c[0],
+                        s,
+                        c[2]
+                    ))
+        print('7. Figure context added')
+    write_derivatives(image_folder)
+    print('8. Figure thumbnails written')
+
+    return image_content
+
+
+def document_spans(file_name):
+    """
+    Streams the text of pdfs/<file_name> as (text, page, section) spans for TextDatabase.upsert
+
+    Bold spans starting a line are the headers detected by data_prep (bold words inside a line
+    are not), a header opens a section nested under the open headers of larger font size,
+    section is the path of open headers joined by ' > '
+    Table of contents and index pages are skipped
+    """
+
+    def findWholeWord(w):
+        return re.compile(r'\b{0}\b'.format(re.escape(w)), flags=re.IGNORECASE).search
+
+    pdf_file_path = os.path.join(os.getcwd(), 'pdfs', file_name)
+    headers = []  # open headers, (font size, text)
+    with fitz.open(pdf_file_path) as pdf_file:
+        for page_num, page in enumerate(pdf_file):
+            texts = page.get_text('dict')
+            if any(findWholeWord(w)(page.get_text()) for w in ('table of contents', 'index')):
+                continue
+            for block in texts['blocks']:
+                if block['type'] != 0:
+                    continue
+                for line in block['lines']:
+                    for n, span in enumerate(line['spans']):
+                        text = span['text'].replace('}', '-').replace('{', '-')
+                        if n == 0 and 'bol' in span['font'].lower() and not text.isnumeric() and text.strip():
+                            while headers and headers[-1][0] <= span['size']:
+                                headers.pop()
+                            headers.append((span['size'], text.strip()))
+                        yield text, page_num, " > ".join(h for _, h in headers)
+                    yield '\n', page_num, " > ".join(h for _, h in headers)
+
+
+def caption_figures(image_content, captioner):
+    """
+    Appends a model caption of every figure to its context
+    The figures are captioned concurrently, see ChatGPT.image_batch
+    """
+
+    captions = captioner.image_batch([c[2] for c in image_content])
+    return [(name, context + '\n' + caption, image)
+            for (name, context, image), caption in zip(image_content, captions)]
+
+
+def vector_databases(extractor, image_model, weaviate_embed, pinecone_embed, uri='lancedb/rag',
+                     quantization=None, child_size=None):
+    """
+    Returns the two vector stores with their models prepared
+    quantization is the vector storage of the stores, see Database (default RAG_QUANTIZATION)
+    child_size > 0 indexes the text chunks small-to-big, see TextDatabase.model_prep
+    (default RAG_CHILD_SIZE), both read at each call
+    """
+
+    if quantization is None:
+        quantization = os.getenv('RAG_QUANTIZATION', 'float32')
+    if child_size is None:
+        child_size = int(os.getenv('RAG_CHILD_SIZE', 0))
+
+    vb1 = UnifiedDatabase('vb1', uri, quantization)
+    vb1.model_prep(extractor, image_model, weaviate_embed,
+                   RecursiveCharacterTextSplitter(chunk_size=1330, chunk_overlap=35), child_size)
+    vb2 = UnifiedDatabase('vb2', uri, quantization)
+    vb2.model_prep(extractor, image_model, pinecone_embed,
+                   RecursiveCharacterTextSplitter(chunk_size=1330, chunk_overlap=35), child_size)
+    return [vb1, vb2]
+
+
+def vector_database_prep(file_name, extractor, image_model, weaviate_embed, pinecone_embed, uri='lancedb/rag',
+                         captioner=None, profile=None, request_id=None):
+    """
+    Ingests pdfs/<file_name> into the two vector stores and returns them
+    captioner (see Models.load_captioner) optionally adds figure captions to the figure contexts
+    With profile (default RAG_PROFILE) the ingestion is profiled, see src/Profiling.py
+    """
+
+    with profiled('ingest', request_id, profile):
+        vb_list = vector_databases(extractor, image_model, weaviate_embed, pinecone_embed, uri)
+        image_content = data_prep(file_name)
+        if captioner is not None and image_content:
+            image_content = caption_figures(image_content, captioner)
+        spans = list(document_spans(file_name))  # the pdf is parsed once for both stores
+        for vb in vb_list:
+            vb.upsert(spans)
+            vb.upsert(image_content, document=file_name)  # image_cont = dict[image_file_path, context, PIL]
+        record_ingestion(uri, file_name)
+    return vb_list
+
+
+def ingested_files(uri='lancedb/rag'):
+    """
+    Returns the names of the pdfs ingested into the stores at uri
+    """
+
+    path = os.path.join(uri, 'ingested.json')
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return json.load(f)
+
+
+def record_ingestion(uri, file_name):
+    """
+    Adds file_name to the list of ingested pdfs, other processes serving the stores
+    watch this file to pick up new tables
+    """
+
+    files = ingested_files(uri)
+    if file_name not in files:
+        files.append(file_name)
+    path = os.path.join(uri, 'ingested.json')
+    with open(path + '.tmp', 'w') as f:
+        json.dump(files, f)
+    os.replace(path + '.tmp', path)
@@ -0,0 +1,73 @@
+import fcntl
+import os
+
+SHARED_DIR = os.getenv('RAG_SHARED_WEIGHTS', '')
+
+
+def _module(model):
+    """
+    The torch module holding the weights of model (or of its model attribute for wrappers)
+    """
+
+    import torch
+
+    if isinstance(model, torch.nn.Module):
+        return model
+    if isinstance(getattr(model, 'model', None), torch.nn.Module):
+        return model.model
+    raise TypeError('Model has to be a torch Module or wrap one as its model attribute')
+
+
+def export_weights(module, path):
+    """
+    Writes the state dict of module to path once, concurrent exporters wait for the first one
+    """
+
+    import torch
+
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if not os.path.exists(path):
+            torch.save(module.state_dict(), path + '.tmp')
+            os.replace(path + '.tmp', path)
+
+
+def share(model, name, directory=None):
+    """
+    Replaces the weights of model by read-only memory maps of directory/<name>.pt
+
+    The first process exports the weights it loaded, every process (including the first)
+    then maps the file, so the weights live once in the page cache and are shared by all
+    workers of the machine instead of being copied into each one. The private copy loaded
+    by the caller is freed once its tensors are replaced.
+    Returns model, unchanged when no directory is configured (RAG_SHARED_WEIGHTS)
+    """
+
+    directory = SHARED_DIR if directory is None else directory
+    if not directory:
+        return model
+    import torch
+
+    module = _module(model)
+    path = os.path.join(directory, name.replace('/', '--') + '.pt')
+    export_weights(module, path)
+    state = torch.load(path, mmap=True, weights_only=True, map_location='cpu')
+    module.load_state_dict(state, assign=True)
+    module.eval().requires_grad_(False)
+    return model
+
+
+def rss():
+    """
+    Resident and proportional set size (bytes) of the current process, PSS counts
+    shared pages divided by the number of processes mapping them (Linux only)
+    """
+
+    sizes = {}
+    with open('/proc/self/smaps_rollup') as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            if key in ('Rss', 'Pss'):
+                sizes[key.lower()] = int(value.split()[0]) * 1024
+    return sizes
@@ -0,0 +1,274 @@
+import asyncio
+import base64
+import os
+import random
+import threading
+import time
+from io import BytesIO
+import httpx
+from src.Cache import LRUCache, image_hash
+from src.Model_host import share
+from langchain.schema.output_parser import StrOutputParser
+
+
+# Embedding Model
+class SentenceTransformerEmbeddings:
+    """
+      Wrapper Class for SentenceTransformer Class
+    """
+
+    def __init__(self, model_name: str):
+        """
+          Initiliases a Sentence Transformer
+        """
+        from sentence_transformers import SentenceTransformer
+
+        self.model_name = model_name  # tells the models apart in Cache.embeddings keys
+        self.model = SentenceTransformer(model_name)
+
+    def embed_documents(self, texts):
+        """
+        Returns a list of embeddings for the given texts.
+        """
+        return self.model.encode(texts, convert_to_tensor=True).tolist()
+
+    def embed_query(self, text):
+        """
+          Returns a list of embeddings for the given text.
+        """
+        return self.model.encode(text, convert_to_tensor=True).tolist()
+
+    def embed_queries(self, texts):
+        """
+          Returns the embed_query embeddings of several texts, encoded as one batch.
+        """
+        return self.model.encode(texts, convert_to_tensor=True).tolist()
+
+
+# Parser
+class MistralParser:
+    """
+      Wrapper Class for StrOutputParser Class
+      Custom made for Mistral models
+    """
+
+    def __init__(self, stopword='Answer:'):
+        """
+          Initiliases a StrOutputParser as the base parser
+        """
+        self.parser = StrOutputParser()
+        self.stopword = stopword
+
+    def invoke(self, query):
+        """
+          Invokes the parser and finds the Model response
+        """
+        ans = self.parser.invoke(query)
+        return ans[ans.find(self.stopword)+len(self.stopword):].strip()
+
+
+class HTTPPool:
+    """
+    Process-wide keep-alive connection pools (sync and async) to the OpenAI API
+
+    Requests are retried on connection errors, 429 and 5xx with exponential
+    backoff and full jitter
+    """
+
+    timeout = httpx.Timeout(60.0, connect=10.0)
+    limits = httpx.Limits(max_connections=32, max_keepalive_connections=16)
+    retries = 4
+    backoff = 0.5
+    _lock = threading.Lock()
+    _client = None
+
+    @classmethod
+    def client(cls):
+        if cls._client is None:
+            with cls._lock:
+                if cls._client is None:
+                    cls._client = httpx.Client(timeout=cls.timeout, limits=cls.limits)
+        return cls._client
+
+    @classmethod
+    def _delay(cls, attempt):
+        return random.uniform(0, cls.backoff * 2 ** attempt)
+
+    @staticmethod
+    def _retryable(response):
+        return response.status_code == 429 or response.status_code >= 500
+
+    @classmethod
+    def post(cls, url, headers, payload):
+        for attempt in range(cls.retries + 1):
+            try:
+                response = cls.client().post(url, headers=headers, json=payload)
+                if not cls._retryable(response) or attempt == cls.retries:
+                    return response.json()
+            except httpx.TransportError:
+                if attempt == cls.retries:
+                    raise
+            time.sleep(cls._delay(attempt))
+
+    @classmethod
+    async def apost(cls, client, url, headers, payload):
+        for attempt in range(cls.retries + 1):
+            try:
+                response = await client.post(url, headers=headers, json=payload)
+                if not cls._retryable(response) or attempt == cls.retries:
+                    return response.json()
+            except httpx.TransportError:
+                if attempt == cls.retries:
+                    raise
+            await asyncio.sleep(cls._delay(attempt))
+
+
+class ChatGPT:
+    """
+      Wrapper Class for ChatGPT Class
+    """
+
+    url = "https://api.openai.com/v1/chat/completions"
+    max_side = 768  # images are downscaled to this longest side before upload
+    concurrency = 8
+    # image hash -> base64 JPEG payload, shared by all wrappers
+    payloads = LRUCache(max_bytes=32 * 2 ** 20, sizeof=len)
+
+    def __init__(self, model, api_key, template, url=None):
+        from openai import OpenAI
+
+        self.model = model
+        self.api_key = api_key
+        self.client = OpenAI(api_key=api_key)
+        self.template = template
+        self.url = url or self.url
+
+    @classmethod
+    def image_payload(cls, img):
+        """
+          Downscaled base64 JPEG of img, cached by the hash of its pixels
+        """
+
+        def encode():
+            im = img.convert('RGB')
+            im.thumbnail((cls.max_side, cls.max_side))
+            buffered = BytesIO()
+            im.save(buffered, format="JPEG", quality=85)
+            return base64.b64encode(buffered.getvalue()).decode("utf-8")
+
+        return cls.payloads.get_or_compute(image_hash(img), encode)
+
+    def _request(self, image):
+        headers = {"Content-Type": "application/json", "Authorization": f"Bearer {self.api_key}"}
+        payload = {"model": self.model,
+                   "messages": [{"role": "user",
+                                 "content": [{"type": "text", "text": self.template},
+                                             {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{self.image_payload(image)}"}}]
+                                 }
+                                ], "max_tokens": 20}
+        return headers, payload
+
+    @staticmethod
+    def _content(res):
+        if 'error' not in res:
+            return res['choices'][0]['message']['content']
+        else:
+            return res['error']['message']
+
+    def image(self, image):
+        """
+          Image to Text Conversion
+        """
+
+        return self._content(HTTPPool.post(self.url, *self._request(image)))
+
+    async def aimage(self, image, client):
+        return self._content(await HTTPPool.apost(client, self.url, *self._request(image)))
+
+    async def aimage_batch(self, images, concurrency=None):
+        semaphore = asyncio.Semaphore(concurrency or self.concurrency)
+
+        async def one(image):
+            async with semaphore:
+                return await self.aimage(image, client)
+
+        async with httpx.AsyncClient(timeout=HTTPPool.timeout, limits=HTTPPool.limits) as client:
+            return await asyncio.gather(*[one(image) for image in images])
+
+    def image_batch(self, images, concurrency=None):
+        """
+          Image to Text Conversion of many images, at most concurrency requests in flight
+        """
+
+        return asyncio.run(self.aimage_batch(list(images), concurrency))
+
+    def chat(self, prompt):
+        """
+          Text Conversation
+        """
+        message = [{"role": "user", "content": prompt.messages[0].content}]
+        return self.client.chat.completions.create(messages=message, model=self.model).choices[0].message.content
+
+
+# Model loaders, shared by the Streamlit pages and the HTTP service
+# Encoder weights are memory-mapped and shared between processes when RAG_SHARED_WEIGHTS is set, see Model_host
+# The model libraries are imported by the loaders, importing this module does not load torch
+def pine_embedding_model():
+    return share(SentenceTransformerEmbeddings(model_name="all-mpnet-base-v2"), "all-mpnet-base-v2")  # 784 dimension + euclidean
+
+
+def weaviate_embedding_model():
+    return share(SentenceTransformerEmbeddings(model_name="all-MiniLM-L6-v2"), "all-MiniLM-L6-v2")
+
+
+def load_image_model(model):
+    from transformers import AutoFeatureExtractor, AutoModel
+
+    extractor = AutoFeatureExtractor.from_pretrained(model)
+    im_model = share(AutoModel.from_pretrained(model), model)
+    return extractor, im_model
+
+
+def load_cross():
+    from sentence_transformers import CrossEncoder
+
+    return share(CrossEncoder("cross-encoder/ms-marco-TinyBERT-L-2-v2", max_length=512, device="cpu"),
+                 "cross-encoder/ms-marco-TinyBERT-L-2-v2")
+
+
+def load_chat_model():
+    template = '''
+    You are an assistant for question-answering tasks.
+    Use the following pieces of retrieved context to answer the question accurately.
+    If the question is not related to the context, just answer 'I don't know'.
+    Question: {question}
+    Context: {context}
+    Answer:
+    '''
+    from langchain_community.llms import HuggingFaceHub
+
+    return HuggingFaceHub(
+        repo_id="mistralai/Mistral-7B-Instruct-v0.1",
+        model_kwargs={"temperature": 0.5, "max_length": 64, "max_new_tokens": 512, "query_wrapper_prompt": template}
+    )
+
+
+def load_q_model():
+    from langchain_community.llms import HuggingFaceHub
+
+    return HuggingFaceHub(
+        repo_id="mistralai/Mistral-7B-Instruct-v0.3",
+        model_kwargs={"temperature": 0.5, "max_length": 64, "max_new_tokens": 512}
+    )
+
+
+def load_captioner():
+    """
+    Figure captioning model used at ingestion, None unless RAG_CAPTION_MODEL is set
+    """
+
+    model = os.getenv('RAG_CAPTION_MODEL')
+    if not model:
+        return None
+    return ChatGPT(model, api_key=os.getenv('OPENAI_API_KEY'),
+                   template='Describe this figure of a technical manual in one sentence.')
@@ -0,0 +1,69 @@
+import os
+import threading
+import weakref
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from langchain_core.runnables import RunnableLambda
+from src.Models import MistralParser
+from src.Rag_chain import RAGEval
+
+_pipelines = {}  # config -> (weak references to the stores and models, pipeline), the latest per config
+_lock = threading.Lock()
+
+
+def config_from_env():
+    """
+    Pipeline configuration from the RAG_* environment variables
+    """
+
+    return {
+        "agent": os.getenv('RAG_AGENT', 'tree'),
+        "compression": os.getenv('RAG_COMPRESSION', ''),
+        "compression_budget": int(os.getenv('RAG_COMPRESSION_BUDGET', 256)),
+        "rerank_cap": int(os.getenv('RAG_RERANK_CAP', 0)),
+        "time_budget": float(os.getenv('RAG_TIME_BUDGET', 0)),
+        "uri": os.getenv('RAG_URI', './lancedb/rag'),
+        "feedback_file": os.getenv('RAG_FEEDBACK_FILE', './feedback_journal.jsonl')
+    }
+
+
+def build_pipeline(vb_list, chat_model, q_model, cross_model, feedback_embed, config):
+    """
+    Builds the RAGEval pipeline used by the Streamlit pages and the HTTP service
+    """
+
+    rag = RAGEval(vb_list, cross_model)
+    rag.model_prep(chat_model, RunnableLambda(MistralParser().invoke))
+    rag.query_agent_prep(q_model, (RunnableLambda(MistralParser('alternate-questions :\n').invoke),
+                                   RunnableLambda(MistralParser('sub-question : ').invoke),
+                                   RunnableLambda(MistralParser().invoke)),
+                         agent=config['agent'])
+    rag.feedback_prep(uri=config['uri'], table_name='feedback',
+                      file=config['feedback_file'], embedder=feedback_embed,
+                      splitter=RecursiveCharacterTextSplitter(chunk_size=1330, chunk_overlap=35))
+    if config['compression']:  # extractive or llmlingua
+        rag.compression_prep(config['compression_budget'], config['compression'])
+    if config['rerank_cap']:  # bi-encoder pre-filter before the cross-encoder
+        rag.rerank_prep(config['rerank_cap'])
+    if config['time_budget']:  # seconds per query before the agent stops iterating
+        rag.time_budget = config['time_budget']
+    return rag
+
+
+def get_pipeline(vb_list, chat_model, q_model, cross_model, feedback_embed, config=None):
+    """
+    Returns the process-wide pipeline for the given configuration and ingested stores,
+    building it on first use. Only the latest pipeline of a configuration is kept, it is
+    rebuilt when the stores or models are other objects (compared by identity, not id)
+
+    The pipeline is shared: callers keep per-request state on copy.copy(pipeline)
+    """
+
+    config = config_from_env() if config is None else config
+    key = tuple(sorted(config.items()))
+    objects = list(vb_list) + [chat_model, q_model, cross_model, feedback_embed]
+    with _lock:
+        refs, rag = _pipelines.get(key, ((), None))
+        if len(refs) != len(objects) or any(ref() is not o for ref, o in zip(refs, objects)):
+            rag = build_pipeline(vb_list, chat_model, q_model, cross_model, feedback_embed, config)
+            _pipelines[key] = (tuple(weakref.ref(o) for o in objects), rag)  # replaces the one of older objects
+    return rag
@@ -0,0 +1,121 @@
+"""
+On-demand sampling profiles of single requests
+
+A request is profiled when RAG_PROFILE is set (every query and ingestion of the process),
+when the server receives the X-Profile header and RAG_PROFILE_HEADER allows it, or when a
+Streamlit session is opened with ?profile=1. The artifacts are written to RAG_PROFILE_DIR
+as <name>-<request id>, ids other than 1 to 64 letters, digits, _ and - are replaced, with
+1. .html: interactive call tree and timeline (pyinstrument)
+2. .speedscope.json: flamegraph, open it in https://www.speedscope.app
+3. .txt: call tree with the time of every frame
+
+Profiling follows the request into the worker threads of the agents (see propagate), the
+shared batching threads of src/Batching.py are not attributed to a request, their time
+shows as the wait on the batch. Disabled, the cost is a flag check per request and
+pyinstrument is not imported
+"""
+import contextlib
+import os
+import re
+import threading
+import uuid
+
+PROFILE = os.getenv('RAG_PROFILE', '') not in ('', '0')
+PROFILE_HEADER = os.getenv('RAG_PROFILE_HEADER', '') not in ('', '0')  # clients may ask for a profile
+PROFILE_DIR = os.getenv('RAG_PROFILE_DIR', './profiles')
+INTERVAL = 0.001  # seconds between samples
+
+_local = threading.local()  # sessions of the workers of the request profiled by this thread
+
+
+_REQUEST_ID = re.compile(r'[A-Za-z0-9_-]{1,64}')
+
+
+def safe_request_id(value=None):
+    """
+    value when it is safe in a file name and a header, otherwise a new id
+    """
+
+    return value if value and _REQUEST_ID.fullmatch(value) else uuid.uuid4().hex[:12]
+
+
+def active():
+    return getattr(_local, 'sessions', None) is not None
+
+
+@contextlib.contextmanager
+def profiled(name, request_id=None, enabled=None, directory=None):
+    """
+    Profiles the block when enabled (default RAG_PROFILE), yields a dict with the
+    request_id, filled with the artifact paths once the block exits, or None when disabled
+    Profiles do not nest, a profiled call inside a profiled request is part of its profile
+    """
+
+    if not (PROFILE if enabled is None else enabled) or active():
+        yield None
+        return
+    from pyinstrument import Profiler
+
+    report = {"request_id": safe_request_id(request_id)}
+    _local.sessions = []
+    profiler = Profiler(interval=INTERVAL, async_mode='disabled')
+    profiler.start()
+    try:
+        yield report
+    finally:
+        session = profiler.stop()
+        sessions, _local.sessions = _local.sessions, None
+        try:
+            report["artifacts"] = write(session, sessions, f"{name}-{report['request_id']}",
+                                        PROFILE_DIR if directory is None else directory)
+        except Exception as e:  # a failed profile never fails the request
+            report["error"] = f"{type(e).__name__}: {e}"
+            print(f"Profile of {name}-{report['request_id']} not written: {report['error']}")
+
+
+def propagate(fn):
+    """
+    Wraps fn, about to run in a worker thread, to add its samples to the profile of the
+    current request. Returns fn itself when the request is not profiled
+    """
+
+    if not active():
+        return fn
+    from pyinstrument import Profiler
+
+    sessions = _local.sessions
+
+    def profiled_fn(*args, **kwargs):
+        _local.sessions = sessions  # work the worker hands on is profiled too
+        profiler = Profiler(interval=INTERVAL, async_mode='disabled')
+        profiler.start()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            sessions.append(profiler.stop())
+            _local.sessions = None
+
+    return profiled_fn
+
+
+def write(session, worker_sessions, stem, directory):
+    """
+    Writes the artifacts of the session merged with the sessions of its worker threads,
+    returns their paths
+    """
+
+    from pyinstrument.renderers import ConsoleRenderer, HTMLRenderer, SpeedscopeRenderer
+    from pyinstrument.session import Session
+
+    for s in worker_sessions:
+        session = Session.combine(session, s)
+    os.makedirs(directory, exist_ok=True)
+    artifacts = {}
+    for ext, renderer in (('html', HTMLRenderer()), ('speedscope.json', SpeedscopeRenderer()),
+                          ('txt', ConsoleRenderer(unicode=False, color=False, show_all=False))):
+        path = os.path.join(directory, f"{stem}.{ext}")
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(renderer.render(session))
+        artifacts[ext] = path
+    print(f"Profile of {stem}: {artifacts['txt']}")
+    return artifacts
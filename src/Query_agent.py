@@ -1,23 +1,150 @@
 from langchain.schema.output_parser import StrOutputParser
 from langchain.prompts import ChatPromptTemplate
 from langchain.schema.runnable import RunnablePassthrough
+from langchain_core.runnables import RunnableLambda
+import json
 import re
-from src.Databases import *
+import threading
+import time
+import numpy as np
+from abc import ABC, abstractmethod
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from src.Cache import embedder_name, embeddings
+from src.Profiling import propagate
+
+
+def pieces(context):
+    """
+    Lines of a context cut at sentence ends, the contexts handed on by the agents' fetch
+    """
+
+    return [p for p in re.split("(\\.|\\?|!)\n", context) if p not in '.?!']
 
 
 class ContextAgent(ABC):
     """
     Base Class for Query Context Agents
+
+    Iterative agents stop early once a turn retrieves nothing novel, i.e. every new
+    chunk has a word overlap of at least novelty_threshold with one already retrieved,
+    or once the deadline of the request (a time.perf_counter() time, see RAGEval.query)
+    has passed. Called without a deadline, the query gets time_budget seconds (if set)
+
+    Retrieval fuses the chunks of all stores before reranking, see candidates()
     """
 
+    novelty_threshold = 0.9
+    time_budget = None
+    fusion_k = 4  # chunks retrieved from each store
+    fusion_cap = 6  # fused chunks sent to the cross-encoder
+
     def __init__(self, vb_list, q_model, cross_model, parser):
         self.vb_list = vb_list
         self.q_model = q_model
         self.cross_model = cross_model
         self.parser = parser
+        self._local = threading.local()
+
+    @property
+    def trace(self):
+        """
+        Trace of the last query made from the current thread
+        """
+
+        if not hasattr(self._local, 'trace'):
+            self._local.trace = {}
+        return self._local.trace
+
+    def _new_trace(self):
+        self._local.trace = {}
+        return self._local.trace
+
+    def _is_novel(self, chunk, seen):
+        """
+        If chunk is not a near duplicate (word set Jaccard similarity) of any seen chunk
+        """
+
+        words = set(chunk.lower().split())
+        for s in seen:
+            other = set(s.lower().split())
+            if len(words & other) / max(len(words | other), 1) >= self.novelty_threshold:
+                return False
+        return True
+
+    def candidates(self, question):
+        """
+        Chunks retrieved for question from all stores, fused into one capped list
+
+        Distances are min-max normalised per store into similarities, a chunk returned
+        by several stores (same text up to whitespace) adds up its similarities, and
+        the fusion_cap best chunks are kept
+        """
+
+        results = []
+        for vb in self.vb_list:
+            result = vb.query(question, self.fusion_k)
+            self._remember(vb, result['text_data'], result.get('text_vectors'))
+            results.append((result['text_data'], result.get('text_scores') or [0.0] * len(result['text_data'])))
+        return self._fuse(results)
+
+    @staticmethod
+    def _remember(vb, chunks, vectors):
+        """
+        Keeps the stored vectors of retrieved chunks, and of their pieces, in Cache.embeddings,
+        so the rerank pre-filter of RAGEval does not embed them again
+        """
+
+        name = embedder_name(vb.embedder)
+        for chunk, vector in zip(chunks, vectors or []):
+            if vector is not None:
+                vector = np.asarray(vector, dtype=np.float32)
+                for text in [chunk] + pieces(chunk):
+                    embeddings.put((name, text), vector)
+
+    def _fuse(self, results):
+        """
+        Fused chunk list from the (chunks, distances) retrieved from every store
+        """
+
+        fused = {}  # chunk identity -> [chunk, score]
+        for chunks, distances in results:
+            low, high = min(distances, default=0.0), max(distances, default=0.0)
+            for chunk, d in zip(chunks, distances):
+                key = " ".join(chunk.split())
+                if not key:
+                    continue
+                score = 1.0 - (d - low) / (high - low) if high > low else 1.0
+                fused.setdefault(key, [chunk, 0.0])[1] += score
+        ranked = sorted(fused.values(), key=lambda x: x[1], reverse=True)
+        return [chunk for chunk, _ in ranked[:self.fusion_cap]]
+
+    def rerank(self, question, top_k):
+        """
+        The top_k fused chunks by cross-encoder score
+        """
+
+        chunks = self.candidates(question)
+        if not chunks:
+            return []
+        ranked = self.cross_model.rank(query=question, documents=chunks, return_documents=True)
+        return [r['text'] for r in ranked[:top_k]]
+
+    def _deadline(self, deadline):
+        """
+        deadline, or time_budget seconds from now when the caller gave none
+        """
+
+        if deadline is None and self.time_budget is not None:
+            return time.perf_counter() + self.time_budget
+        return deadline
+
+    @staticmethod
+    def _out_of_time(deadline):
+        return deadline is not None and time.perf_counter() > deadline
 
     @abstractmethod
-    def query(self, question):
+    def query(self, question, deadline=None):
         raise NotImplementedError('Implement Query function')
 
     @abstractmethod
@@ -55,29 +182,35 @@ class QueryAgent(ContextAgent):
         return result
 
     def fetch(self, question):
-        prior_context = [vb.query(question)['text_data'] for vb in self.vb_list]
-        cont = ["".join(i) for i in prior_context]
-        c = self.cross_model.rank(
-            query=question,
-            documents=cont,
-            return_documents=True
-          )[:len(cont)-self.best+1]
-        return [i['text'] for i in c]
+        return self.rerank(question, self.best)
 
     def execute(self):
         content = "\n".join([message["content"] for message in self.messages if (message["role"] != "assistant")])
         return self.parser.invoke(self.q_model.invoke(content, max_length=128, num_return_sequences=1))
 
-    def query(self, question):
+    def query(self, question, deadline=None):
+        trace = self._new_trace()
+        deadline = self._deadline(deadline)
         self.question = question
         self.context, context = "", ""
+        seen = []
 
+        turns = 0
         for i in range(self.max_turns):
+            if i > 0 and self._out_of_time(deadline):  # the first turn always runs
+                trace['stop'] = 'time_budget'
+                break
             self.context += context + '\n'
             subq = self(question, context)
             print(f"Sub question: {subq}\n")
-            question, context = subq, "".join(self.fetch(subq))
+            question, context = subq, "\n".join(self.fetch(subq))
+            turns += 1
             print(f"Context: {context}\n")
+            if not self._is_novel(context, seen):
+                trace['stop'] = 'converged'
+                break
+            seen.append(context)
+        trace['turns'] = turns
         return self.context
 
 
@@ -112,9 +245,9 @@ class AlternateQuestionAgent(ContextAgent):
         uni_q.append(q)
     return uni_q  # assuming the questions are labelled as 1. q1 \n 2. q2
 
-  def query(self, question):
+  def query(self, question, deadline=None):
     """
-      Returns the cumulative context for the given question
+      Returns the cumulative context for the given question (a single turn, the deadline is not checked)
     """
 
     questions = self.mul_qs(question)
@@ -127,20 +260,7 @@ class AlternateQuestionAgent(ContextAgent):
       Returns the context for the given question
     """
 
-    prior_context = [vb.query(question)['text_data'] for vb in self.vb_list]
-    cont = []
-    for i in prior_context:
-      context = ""
-      for j in i:  # list to str
-        context += j
-      cont.append(context)
-
-    c = self.cross_model.rank(
-      query=question,
-      documents=cont,
-      return_documents=True
-    )[:len(prior_context) - self.best + 1]
-    return [i['text'] for i in c]  # list of text
+    return self.rerank(question, self.best)  # list of text
 
   def fetch(self, questions):
     """
@@ -155,10 +275,7 @@ class AlternateQuestionAgent(ContextAgent):
           uni_contexts.append(j)
     u = []
     for i in uni_contexts:
-      k = re.split("(\.|\?|!)\n", i)
-      for j in k:
-        if j in '.?!':
-          continue
+      for j in pieces(i):
         if j not in u:
           u.append(j)
     uni_contexts = []
@@ -204,23 +321,11 @@ class SubQueryAgent(ContextAgent):
         super().__init__(vb_list, q_model, cross_model, parser)
 
     def fetch(self, question):
-        prior_context = [vb.query(question)['text_data'] for vb in self.vb_list]
-        cont = []
-        for i in prior_context:
-            context = ""
-            for j in i:  # list to str
-                context += j
-            cont.append(context)
-
-        c = self.cross_model.rank(
-            query=question,
-            documents=cont,
-            return_documents=True
-        )[:len(prior_context) - self.best + 1]
-        return [i['text'] for i in c]  # list of text
-
-    def query(self, question):
-        question = question
+        return self.rerank(question, self.best)  # list of text
+
+    def query(self, question, deadline=None):
+        trace = self._new_trace()
+        deadline = self._deadline(deadline)
         all_sub_qs = []
         agent = self._QueryGen(self.q_model, self.parser)
         sub_q = agent(question)
@@ -232,16 +337,26 @@ class SubQueryAgent(ContextAgent):
     You must generate a question based on the main question, and all of the sub-question and sub-contexts pairs.
     Output should in the format: sub-question : <sub_question>        
         """
+        turns = 0
         for i in range(self.turns - 1):
+            if i > 0 and self._out_of_time(deadline):  # the first turn always runs
+                trace['stop'] = 'time_budget'
+                break
             print(f"ITERATION NO: {i+1}")
             context = self.fetch(sub_q)
+            turns += 1
+            novel = [c for c in context if self._is_novel(c, contexts)]
             contexts += context
+            if len(novel) == 0:
+                trace['stop'] = 'converged'
+                break
             total_context = "\n".join(contexts)
             agent = self._QueryGen(self.q_model, self.parser,
                     prompt=prompt+"\nsub-question : {Question}\nsub-context: {Context}")
             prompt += f"\nsub-question : {sub_q}\nsub-context: {total_context}"
             sub_q = agent(sub_q, total_context)
             print(f"{i+2}th Sub question: {sub_q}\n")
+        trace['turns'] = turns
         uni = []
         for c in contexts:
             if c not in uni:
@@ -254,23 +369,68 @@ class TreeOfThoughtAgent(ContextAgent):
       Forms multiple questions for a given question
       Prepares some serial subquestion for each of the alternate question
       Fetches contexts for each subquestion and returns the sum of them
+
+      With speculative set, the sub-question chain of the original question (always one
+      of the questions) starts while the alternate questions are generated, and the
+      chains of all questions run concurrently (at most max_parallel), so one chain's
+      retrieval overlaps another's generation. The chains are independent, the contexts
+      are the same as run one after the other. The trace reports the latency hidden
+      RAGEval.query_many bounds the LLM calls of all chains of all questions together
     """
 
+    speculative = True
+    max_parallel = 4
+
     def __init__(self, vb_list, model, cross_model, parser=(RunnableLambda(lambda x: x), RunnableLambda(lambda x: x))):
         super().__init__(vb_list, model, cross_model, parser)
         self.alt_agent = RunnableLambda(AlternateQuestionAgent(vb_list, model, cross_model, parser[0]).mul_qs)
-        self.sub_agent = RunnableLambda(SubQueryAgent(vb_list, model, cross_model, parser[1]).query)
+        self.sub_query_agent = SubQueryAgent(vb_list, model, cross_model, parser[1])
 
-    def query(self, question):
+    def query(self, question, deadline=None):
         """
           Returns the cumulative context for the given question
+          All sub-question chains share the deadline
         """
 
-        contexts = []
-        for q in self.alt_agent.invoke(question):  # multiple alternate questions
+        trace = self._new_trace()
+        start = time.perf_counter()
+        deadline = self._deadline(deadline)
+        if self.speculative:
+            with ThreadPoolExecutor(self.max_parallel) as pool:
+                chains = {question: pool.submit(propagate(self._sub_chain), question, deadline)}  # before mul_qs returns
+                questions, generation = self._alternates(question)
+                for q in questions:
+                    if q not in chains:
+                        chains[q] = pool.submit(propagate(self._sub_chain), q, deadline)
+                results = [chains[q].result() for q in questions]
+        else:
+            questions, generation = self._alternates(question)
+            results = [self._sub_chain(q, deadline) for q in questions]
+        elapsed = time.perf_counter() - start
+        serial = generation + sum(r[2] for r in results)
+        trace.update({"sub_turns": [r[1] for r in results], "serial_latency": serial,
+                      "hidden_latency": max(serial - elapsed, 0.0)})
+        return self.fetch([r[0] for r in results])
+
+    def _alternates(self, question):
+        """
+          Alternate questions (multiple alternate questions) and the time taken to generate them
+        """
+
+        start = time.perf_counter()
+        questions = self.alt_agent.invoke(question)
+        for q in questions:
             print(f"Question: {q}")
-            contexts.append(self.sub_agent.invoke(q))  # context retrieved for each multiple question
-        return self.fetch(contexts)
+        return questions, time.perf_counter() - start
+
+    def _sub_chain(self, question, deadline=None):
+        """
+          Context retrieved for a question by the sub-question chain, with its turns and duration
+        """
+
+        start = time.perf_counter()
+        context = self.sub_query_agent.query(question, deadline)
+        return context, self.sub_query_agent.trace.get('turns'), time.perf_counter() - start
 
     def fetch(self, contexts):
         """
@@ -283,10 +443,7 @@ class TreeOfThoughtAgent(ContextAgent):
                 uni_contexts.append(i)
         u = []
         for i in uni_contexts:
-            k = re.split("(\.|\?|!)\n", i)
-            for j in k:
-                if j in '.?!':
-                    continue
+            for j in pieces(i):
                 if j not in u:
                     u.append(j)
         uni_contexts = []
@@ -300,6 +457,248 @@ class TreeOfThoughtAgent(ContextAgent):
         return "@@".join(uni_contexts)
 
 
+class PlanningAgent(ContextAgent):
+    """
+      Plans the retrieval of a question in a single LLM call: alternate questions and the
+      sub-questions of every question, as JSON. All planned questions are then embedded,
+      searched and reranked as one batch, and the contexts are cleaned as TreeOfThoughtAgent does
+
+      Unlike SubQueryAgent, sub-questions are not refined on the retrieved contexts, one
+      LLM round trip replaces the generation turns of the tree
+    """
+
+    best = 2
+    alternates = 2
+    sub_questions = 2
+    max_queries = 9  # planned questions retrieved for, the original question first
+    template = """You are given a question: {question}
+        Plan how to retrieve the information needed to answer it.
+        Write {alternates} alternate questions with the same meaning, and for the question and
+        each alternate question {sub_questions} sub-questions whose answers are needed to answer it.
+        Do not answer the questions. Output only JSON in this format:
+        {{"questions": [{{"question": "<question>", "sub_questions": ["<sub-question>"]}}]}}
+        Plan:
+        """
+
+    def __init__(self, vb_list, model, cross_model, parser=StrOutputParser()):
+        super().__init__(vb_list, model, cross_model, parser)
+        self.prompt = ChatPromptTemplate.from_template(self.template)
+        self.chain = {"question": RunnablePassthrough(),
+                      "alternates": RunnableLambda(lambda q: self.alternates),
+                      "sub_questions": RunnableLambda(lambda q: self.sub_questions)} | self.prompt | self.q_model | self.parser
+
+    @staticmethod
+    def _questions(plan):
+        """
+          {question: [sub-questions]} of a decoded plan, placeholders dropped
+        """
+
+        items = plan.get('questions') if isinstance(plan, dict) else plan
+        tree = {}
+        for item in items if isinstance(items, list) else []:
+            if isinstance(item, str):
+                item = {"question": item}
+            if not isinstance(item, dict) or not isinstance(item.get('question'), str):
+                continue
+            subs = item.get('sub_questions') or item.get('sub-questions') or item.get('subquestions') or []
+            subs = [s for s in subs if isinstance(s, str) and s.strip() and not s.strip().startswith('<')]
+            if item['question'].strip() and not item['question'].strip().startswith('<'):
+                tree[item['question'].strip()] = [s.strip() for s in subs]
+        return tree
+
+    def parse_plan(self, text):
+        """
+          Plan tree ({question: [sub-questions]}) from the LLM output and how it was read
+          The last JSON plan of the output is used, as the model may echo the prompt,
+          otherwise the quoted questions of a truncated plan or the numbered or question
+          lines, as alternate questions
+        """
+
+        decoder = json.JSONDecoder()
+        tree, start = {}, re.compile(r'[{\[]')
+        m = start.search(text)
+        while m:
+            try:
+                plan, end = decoder.raw_decode(text, m.start())
+            except ValueError:
+                m = start.search(text, m.start() + 1)
+                continue
+            tree = self._questions(plan) or tree
+            m = start.search(text, end)  # values nested in a decoded one are part of it
+        if tree:
+            return tree, 'json'
+        quoted = re.findall(r'"([^"\n]+\?)"', text)  # a truncated plan still holds its questions
+        lines = [re.sub(r'^\s*(?:[-*]|\d+[.)])\s*', '', l).strip() for l in text.split('\n')]
+        found = quoted or [l for l in lines if l.endswith('?') and not l.startswith('You are given')]
+        tree = {q.strip(): [] for q in found}
+        return tree, ('partial' if quoted else 'lines') if tree else 'none'
+
+    def plan(self, question):
+        """
+          Questions to retrieve for, the original question, its alternates and their
+          sub-questions, deduplicated and capped at max_queries, with the plan tree
+        """
+
+        tree, parsed = self.parse_plan(self.chain.invoke(question))
+        queries, seen = [], set()
+        for q in [question] + list(tree) + [s for subs in tree.values() for s in subs]:
+            key = " ".join(q.lower().split())
+            if key not in seen:
+                seen.add(key)
+                queries.append(q)
+        return queries[:self.max_queries], tree, parsed
+
+    def retrieve(self, queries):
+        """
+          The best chunks for every query
+          Each store embeds and searches all queries as one batch, and the fused candidates
+          of all queries are scored by one cross-encoder call
+        """
+
+        frames = [vb.search_many(queries, self.fusion_k) for vb in self.vb_list]
+        for vb, f in zip(self.vb_list, frames):
+            for df in f:
+                self._remember(vb, list(df['chunk']), list(df['vector']) if 'vector' in df else None)
+        candidates = [self._fuse([(list(f[i]['chunk']), list(f[i]['_distance'])) for f in frames])
+                      for i in range(len(queries))]
+        pairs = [[q, c] for q, chunks in zip(queries, candidates) for c in chunks]
+        scores = list(self.cross_model.predict(pairs)) if pairs else []
+        best = []
+        for chunks in candidates:
+            s, scores = scores[:len(chunks)], scores[len(chunks):]
+            ranked = sorted(range(len(chunks)), key=lambda i: s[i], reverse=True)
+            best.append([chunks[i] for i in ranked[:self.best]])
+        return best
+
+    def query(self, question, deadline=None):
+        """
+          Returns the cumulative context for the given question (one planning call, the
+          deadline is not checked)
+        """
+
+        trace = self._new_trace()
+        start = time.perf_counter()
+        queries, tree, parsed = self.plan(question)
+        planned = time.perf_counter()
+        print(f"Plan ({parsed}): {tree}")
+        contexts = self.retrieve(queries)
+        trace.update({"plan": tree, "plan_parsed": parsed, "queries": len(queries), "llm_calls": 1,
+                      "plan_latency": planned - start, "retrieval_latency": time.perf_counter() - planned})
+        return self.fetch([c for chunks in contexts for c in chunks])
+
+    def fetch(self, contexts):
+        return TreeOfThoughtAgent.fetch(self, contexts)
+
+
+class RoutingAgent(ContextAgent):
+    """
+      Picks the cheapest agent likely to answer the question well:
+      1. direct: the single-shot retrieval used for routing
+      2. alternate: AlternateQuestionAgent
+      3. tree: TreeOfThoughtAgent
+      The choice is a small softmax classifier over cheap signals,
+      question length and wording, top cross-encoder score and score margin
+      (cross-encoder logits squashed to (0, 1) by a sigmoid)
+    """
+
+    tiers = ('direct', 'alternate', 'tree')
+    best = 2
+    features = ('bias', 'length', 'multi_part', 'why_how', 'top_score', 'margin')
+    # rows follow tiers, columns follow features
+    weights = [[1.0, -1.5, -2.0, -0.5, 2.0, 2.0],
+               [0.5, 0.0, -0.5, 0.5, 0.5, 0.0],
+               [-0.5, 1.5, 2.0, 1.0, -1.5, -1.5]]
+    max_decisions = 1000  # recent decisions kept for report()
+
+    def __init__(self, vb_list, model, cross_model, parser=(RunnableLambda(lambda x: x), RunnableLambda(lambda x: x))):
+        super().__init__(vb_list, model, cross_model, parser)
+        self.alternate_agent = AlternateQuestionAgent(vb_list, model, cross_model, parser[0])
+        self.tree_agent = TreeOfThoughtAgent(vb_list, model, cross_model, parser)
+        self.decisions = deque(maxlen=self.max_decisions)  # (question, tier, latency)
+
+    def fetch(self, question):
+        """
+          Single-shot retrieval, returns the candidate chunks reranked
+        """
+
+        chunks = self.candidates(question)
+        if not chunks:
+            return []
+        return self.cross_model.rank(query=question, documents=chunks, return_documents=True)
+
+    def signals(self, question, ranked):
+        words = question.lower().split()
+        scores = [float(1 / (1 + np.exp(-float(r['score'])))) for r in ranked] + [0.0, 0.0]
+        return [1.0,
+                len(words) / 20,
+                float(any(w in words for w in ('and', 'or', 'compare', 'vs', 'versus', 'difference', 'between'))),
+                float(any(w in words for w in ('why', 'how', 'explain'))),
+                scores[0],
+                scores[0] - scores[1]]
+
+    def route(self, x):
+        logits = [sum(w * f for w, f in zip(row, x)) for row in self.weights]
+        return self.tiers[logits.index(max(logits))]
+
+    def fit(self, questions, tiers):
+        """
+          Fits the classifier weights on questions labelled with the cheapest tier that answered them well
+        """
+
+        from sklearn.linear_model import LogisticRegression
+
+        x = [self.signals(q, self.fetch(q))[1:] for q in questions]
+        clf = LogisticRegression(max_iter=1000).fit(x, tiers)
+        if len(clf.classes_) == 2:  # binary logistic regression keeps one row, for the second class
+            second = [float(clf.intercept_[0])] + [float(c) for c in clf.coef_[0]]
+            weights = {clf.classes_[0]: [0.0] * len(second), clf.classes_[1]: second}
+        else:
+            weights = {t: [float(b)] + [float(c) for c in coef]
+                       for t, b, coef in zip(clf.classes_, clf.intercept_, clf.coef_)}
+        self.weights = [weights.get(t, [-1e9] + [0.0] * (len(self.features) - 1)) for t in self.tiers]
+
+    def query(self, question, deadline=None):
+        """
+          Returns the context for the given question from the routed agent, which gets the deadline
+        """
+
+        trace = self._new_trace()
+        start = time.perf_counter()
+        deadline = self._deadline(deadline)
+        ranked = self.fetch(question)
+        x = self.signals(question, ranked)
+        tier = self.route(x)
+        print(f"Route: {tier}")
+        if tier == 'direct':
+            context = "@@".join(r['text'] for r in ranked[:self.best])
+        elif tier == 'alternate':
+            context = self.alternate_agent.query(question, deadline)
+        else:
+            context = self.tree_agent.query(question, deadline)
+        latency = time.perf_counter() - start
+        self.decisions.append((question, tier, latency))
+        trace.update({"route": tier, "route_signals": dict(zip(self.features[1:], x[1:])), "route_latency": latency})
+        return context
+
+    def report(self):
+        """
+          Routing decisions and latency per tier over the last max_decisions queries, with
+          the latency saved against the mean tree tier latency, None (n/a) until a query
+          has been routed to the tree tier
+        """
+
+        decisions = list(self.decisions)
+        latencies = {t: [l for _, tier, l in decisions if tier == t] for t in self.tiers}
+        tree = sum(latencies['tree']) / len(latencies['tree']) if len(latencies['tree']) else None
+        report = {}
+        for t in self.tiers:
+            n = len(latencies[t])
+            mean = sum(latencies[t]) / n if n else None
+            saved = 0.0 if t == 'tree' or n == 0 else (None if tree is None else n * (tree - mean))
+            report[t] = {"count": n, "mean_latency": mean, "latency_saved": saved}
+        return report
+
+
 class ImageContextAgent:
     """
     Summarises the context retrieved from an image in a readable format
@@ -1,14 +1,22 @@
+import copy
+import re
+import threading
+import time
+import numpy as np
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from typing_extensions import TypedDict
-from ragas.metrics import (
-    faithfulness,
-    answer_relevancy,
-    context_recall,
-    context_precision
-)
 from langgraph.graph import END, StateGraph
-from ragas import evaluate
-from src.Query_agent import *
-from src.Databases import *
+from langchain.prompts import ChatPromptTemplate
+from langchain.schema.output_parser import StrOutputParser
+from langchain.schema.runnable import RunnablePassthrough
+from langchain_core.runnables import RunnableLambda
+from src.Query_agent import ImageContextAgent, PlanningAgent, RoutingAgent, TreeOfThoughtAgent
+from src.Databases import TextDatabase
+from src.Batching import BatchedDatabase, BatchedCrossEncoder, limited
+from src.Feedback import FeedbackJournal
+from src.Cache import LRUCache, embedder_name, embeddings, image_hash
+from src.Profiling import profiled
 
 
 class RAGEval:
@@ -21,11 +29,17 @@ class RAGEval:
     3. Call query_agent_prep()
     4. Call feedback_prep()
     5. Call imagedb_prep()
-    6. Call query()
+    6. Call query() or query_many()
     """
 
     best = 4
     parse = StrOutputParser()
+    compression = None
+    image_cache_ttl = 3600  # seconds an image query result is reused
+    rerank_cap = None
+    time_budget = None  # seconds per query for the agent's turns, counted from the start of the query
+    deadline = None
+    document = None  # pdf whose figures are returned, None for every ingested pdf
 
     def __init__(self, vb_list, cross_model):
         self.cross_model = cross_model
@@ -42,6 +56,8 @@ class RAGEval:
         self.prompt = ChatPromptTemplate.from_template(self.template)
         self.vb_list = vb_list
         self.ground_truth = ""
+        # image query results by (image hash, top_k, image table versions), shared by copies
+        self.image_cache = LRUCache(max_items=64, ttl=self.image_cache_ttl)
 
     def ground_truths_prep(self, questions):  # questions is a file with questions
         """
@@ -58,20 +74,31 @@ class RAGEval:
         self.chat_model = model
         self.parser = parser_choice
 
-    def query_agent_prep(self, model, parser=parse):
+    def query_agent_prep(self, model, parser=parse, agent='tree'):
         """
           Prepares the query agent
           Current Options:
           1. ReActQueryAgent
           2. AlternateQuestionAgent
           3. AugmentedQueryAgent
-          4. TreeOfThoughtAgent
+          4. TreeOfThoughtAgent (agent='tree')
           5. ImageContextAgent
+          6. RoutingAgent (agent='routed'), picks between direct retrieval,
+             AlternateQuestionAgent and TreeOfThoughtAgent per question
+          7. PlanningAgent (agent='plan'), plans the alternate questions and sub-questions
+             in one LLM call and retrieves for all of them in one batch
         """
 
+        self._agent_args = (model, parser, agent)
         # self.query_agent = RunnableLambda(QueryAgent(self.vb_list, model,self.cross_model, parser).query)
         # self.query_agent = RunnableLambda(AlternateQuestionAgent(self.vb_list, model, self.cross_model, parser).query)
-        self.query_agent = RunnableLambda(TreeOfThoughtAgent(self.vb_list, model, self.cross_model, parser[:2]).query)
+        if agent == 'routed':
+            self.agent = RoutingAgent(self.vb_list, model, self.cross_model, parser[:2])
+        elif agent == 'plan':
+            self.agent = PlanningAgent(self.vb_list, model, self.cross_model, self.parse)
+        else:
+            self.agent = TreeOfThoughtAgent(self.vb_list, model, self.cross_model, parser[:2])
+        self.query_agent = RunnableLambda(self.agent.query)
         self.context_agent = RunnableLambda(ImageContextAgent(model, parser[2]).reword)
         # self.query_agent = RunnableLambda(AugmentedQueryAgent(self.vb_list, model,self.cross_model,parser).query)
 
@@ -83,11 +110,136 @@ class RAGEval:
         """
         self.fd_db = TextDatabase(table_name, uri)
         self.fd_db.model_prep(embedder, splitter)
-        with open(file) as f:
-            data = f.read()
-        self.fd_db.upsert(data)
+        self.feedback_journal = FeedbackJournal(file)  # file is the feedback journal
+        self.feedback_journal.sync(self.fd_db)  # only records added since the last sync are embedded
         self.fd_db.retriever(top_k=5)
 
+    def compression_prep(self, budget=256, method='extractive'):
+        """
+          Adds a context compression stage before the answer LLM
+          Current Options:
+          1. extractive: keeps the sentences the cross-encoder scores highest against the question,
+             in their original order, within budget tokens
+          2. llmlingua: LLMLingua-2 token pruning down to budget tokens
+        """
+
+        if method == 'llmlingua':
+            from llmlingua import PromptCompressor
+            self.compressor = PromptCompressor(model_name="microsoft/llmlingua-2-xlm-roberta-large-meetingbank",
+                                               use_llmlingua2=True, device_map="cpu")
+        elif method != 'extractive':
+            raise ValueError("Compression method should be 'extractive' or 'llmlingua'")
+        self.compression = {"budget": budget, "method": method}
+
+    def rerank_prep(self, cap=8, embedder=None):
+        """
+          Adds a bi-encoder pre-filter before the cross-encoder: of the contexts fetched by
+          the agent, only the cap closest to the question by cosine similarity are reranked
+          embedder defaults to the text embedder of the first store, whose stored chunk
+          vectors are then reused instead of embedding the contexts again
+        """
+
+        self.rerank_cap = cap
+        self.prefilter_embedder = embedder or self.vb_list[0].embedder
+
+    def _embed(self, texts):
+        """
+          Bi-encoder vectors of texts, the ones not in Cache.embeddings (where the agents
+          keep the stored vectors of the chunks they retrieve) are embedded as one batch
+        """
+
+        name = embedder_name(self.prefilter_embedder)
+        vectors = [embeddings.get((name, t)) for t in texts]
+
+        def embed(positions):
+            for i, v in zip(positions, self.prefilter_embedder.embed_documents([texts[i] for i in positions])):
+                vectors[i] = np.asarray(v, dtype=np.float32)
+                embeddings.put((name, texts[i]), vectors[i])
+
+        missing = [i for i, v in enumerate(vectors) if v is None]
+        if missing:
+            embed(missing)
+        # a cached vector of another length was stored by another model under the same name
+        dim = len(vectors[missing[0]]) if missing else Counter(len(v) for v in vectors).most_common(1)[0][0]
+        stale = [i for i, v in enumerate(vectors) if len(v) != dim]
+        if stale:
+            embed(stale)
+        return np.stack(vectors)
+
+    def _prefilter(self, question, contexts, cap):
+        """
+          The cap contexts most similar to the question, in their original order
+        """
+
+        vectors = self._embed([question] + contexts)
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-9)
+        similarity = vectors[1:] @ vectors[0]
+        keep = sorted(np.argsort(-similarity, kind='stable')[:cap])
+        return [contexts[i] for i in keep]
+
+    def _rerank(self, question, contexts, cap=None):
+        """
+          The best contexts for the question by cross-encoder score, after the bi-encoder
+          pre-filter when more than cap (default rerank_cap) contexts were fetched
+        """
+
+        cap = self.rerank_cap if cap is None else cap
+        start = time.perf_counter()
+        if cap and len(contexts) > cap:
+            contexts = self._prefilter(question, contexts, cap)
+        filtered = time.perf_counter()
+        ranked = self.cross_model.rank(query=question, documents=contexts, return_documents=True)[:self.best]
+        self.trace.update({"rerank_candidates": len(contexts), "prefilter_time": filtered - start,
+                           "rerank_time": time.perf_counter() - filtered})
+        return [i['text'] for i in ranked]
+
+    def _count_tokens(self, text):
+        return len(self.cross_model.tokenizer.tokenize(text))
+
+    def _compress(self, question, context):
+        """
+          Internal Method compressing the context of a question to the token budget
+        """
+
+        budget = self.compression['budget']
+        if self.compression['method'] == 'llmlingua':
+            return self.compressor.compress_prompt(context.split('\n'), target_token=budget)['compressed_prompt']
+        sentences = [s.strip() for s in re.split(r'(?<=[.?!])\s+|\n', context) if len(s.strip()) != 0]
+        if self._count_tokens(context) <= budget or len(sentences) == 0:
+            return context
+        scores = self.cross_model.predict([[question, s] for s in sentences])
+        keep, total = [], 0
+        for i in sorted(range(len(sentences)), key=lambda i: scores[i], reverse=True):
+            tokens = self._count_tokens(sentences[i])
+            if total + tokens <= budget:
+                keep.append(i)
+                total += tokens
+        if len(keep) == 0:  # every sentence is over the budget, the best one is cut to it
+            best = max(range(len(sentences)), key=lambda i: scores[i])
+            tokenizer = self.cross_model.tokenizer
+            return tokenizer.convert_tokens_to_string(tokenizer.tokenize(sentences[best])[:budget])
+        return "\n".join(sentences[i] for i in sorted(keep))
+
+    def _batched(self, llm_slots=None):
+        """
+          Returns a copy of the object whose databases and cross-encoder coalesce
+          the calls of concurrent queries into batched calls
+          With llm_slots (a semaphore), the chat and query models, including the calls
+          made from the worker threads of the agents, hold a slot per call
+        """
+
+        batched = copy.copy(self)
+        batched.vb_list = [BatchedDatabase(vb) for vb in self.vb_list]
+        batched.cross_model = BatchedCrossEncoder(self.cross_model)
+        batched.fd_db = BatchedDatabase(self.fd_db)
+        model, parser, agent = self._agent_args
+        if llm_slots is not None:
+            batched.chat_model = limited(self.chat_model, llm_slots)
+            model = limited(model, llm_slots)
+        batched.query_agent_prep(model, parser, agent)
+        batched._agent_args = self._agent_args
+        return batched
+
     def _context_prep(self):
         """
           Internal Method for context preparation for a given question
@@ -96,18 +248,14 @@ class RAGEval:
         def findWholeWord(w):
             return re.compile(r'\b{0}\b'.format(re.escape(w)), flags=re.IGNORECASE).search
 
-        con = self.query_agent.invoke(self.question).split('@@')
+        con = self.agent.query(self.question, self.deadline).split('@@')
+        self.trace.update(self.agent.trace)
         uni_con = []
         for i in con:
             if i not in uni_con:
                 uni_con.append(i)
 
-        c = self.cross_model.rank(
-            query=self.question,
-            documents=uni_con,
-            return_documents=True
-        )[:self.best]
-        cons = [i['text'] for i in c]
+        cons = self._rerank(self.question, uni_con)
 
         self.figure_mentions = []
         for c in cons:
@@ -125,7 +273,8 @@ class RAGEval:
           Utilises the following components:
           1. Feedback retriever
           2. Context Fetcher
-          3. LLM
+          3. Context Compressor (if compression_prep was called)
+          4. LLM
         """
 
         class GraphState(TypedDict):
@@ -184,6 +333,20 @@ class RAGEval:
             self._context_prep()
             return {"question": state["question"], "context": self.context, "answer": ""}
 
+        def compress(state):  # state modifier
+            """
+              Compression Node Function
+              Shrinks the context to the token budget
+            """
+
+            start = time.perf_counter()
+            before = self._count_tokens(state["context"])
+            self.context = self._compress(state["question"], state["context"])
+            self.trace['compression'] = {"method": self.compression['method'], "tokens_before": before,
+                                         "tokens_after": self._count_tokens(self.context),
+                                         "time": time.perf_counter() - start}
+            return {"question": state["question"], "context": self.context, "answer": ""}
+
         def answer(state):  # state modifier
             """
               Answer Node Function
@@ -207,15 +370,39 @@ class RAGEval:
             feedback_check,
             {"f_answer": END, "fetch": "fetch"}
         )
-        self.RAGraph.add_edge("fetch", "answerer")
+        if self.compression is not None:
+            self.RAGraph.add_node("compress", compress)
+            self.RAGraph.add_edge("fetch", "compress")
+            self.RAGraph.add_edge("compress", "answerer")
+        else:
+            self.RAGraph.add_edge("fetch", "answerer")
         self.RAGraph.add_edge("answerer", END)
         self.ragchain = self.RAGraph.compile()
 
-    def query(self, question, top_k=2):
+    def query(self, question, top_k=2, profile=None, request_id=None, document=None):
         """
           Returns text and image results for a given question
+          document restricts the figures mentioned in the answer to those of that pdf
+          Timings and statistics of the run are kept in self.trace
+          With time_budget set, the agent stops starting turns time_budget seconds after the
+          query started
+          With profile (default RAG_PROFILE) the run is profiled, see src/Profiling.py,
+          the trace then holds the request_id and the paths of the profile artifacts
         """
 
+        self.trace = {}
+        self.document = document
+        start = time.perf_counter()
+        self.deadline = start + self.time_budget if self.time_budget else None
+        with profiled('query', request_id, profile) as report:
+            result = self._query(question, top_k)
+        self.trace['latency'] = time.perf_counter() - start
+        if report is not None:
+            self.trace['profile'] = report
+        print(f"Trace: {self.trace}")
+        return result
+
+    def _query(self, question, top_k=2):
         if type(question) is str:  # if query is text
             print(f"MAIN QUESTION {question}")
             self.question = question
@@ -230,15 +417,43 @@ class RAGEval:
                 print('FOUND ONE')
                 for fig in self.figure_mentions:
                     for vb in self.vb_list:
-                        k = vb.search_name(fig)
-                        image += k['image_file'].tolist()
+                        found = vb.find_figure(fig, self.document)  # exact label lookup, vector search for fuzzy labels
+                        image += found if len(found) != 0 else vb.search_name(fig, self.document)['image_file'].tolist()
                 return {"text": text, "image": image, "context": self.context}
         else:  # query is an image
-            text = self._image2text(question)  # get textual information of an image
+            text, image = self._image_query(question, top_k)
             self.context = ""
+            return {"text": text, "image": image, "context": self.context}
         image = self._image_search(question, top_k)
         return {"text": text, "image": image, "context": self.context}
 
+    def _image_query(self, question, top_k=2):
+        """
+          Context summary and images for an image query, cached by the image content
+          The key holds the image table versions, so a write to the stores invalidates it
+        """
+
+        key = (image_hash(question), top_k, tuple(vb.image_version() for vb in self.vb_list))
+        hit = self.image_cache.get(key)
+        self.trace['image_cache'] = 'miss' if hit is None else 'hit'
+        if hit is None:
+            hit = (self._image2text(question), self._image_search(question, top_k))
+            self.image_cache.put(key, hit)
+        return hit
+
+    def query_many(self, questions, top_k=2, max_workers=8):
+        """
+          Returns text and image results for several questions
+          Each question runs the same pipeline as query() in a pool of max_workers threads,
+          at most max_workers LLM calls are in flight (the agents' own threads share the
+          limit), while embeddings, vector searches and cross-encoder scoring from
+          concurrent questions are batched together
+        """
+
+        batched = self._batched(threading.BoundedSemaphore(max_workers))
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            return list(pool.map(lambda q: copy.copy(batched).query(q, top_k), questions))
+
     def _image_search(self, question, top_k=2):
         """
           Returns list of images associated with the query
@@ -275,6 +490,10 @@ class RAGEval:
           Runs RAGAS evaluation on the RAG output
         """
 
+        from datasets import Dataset
+        from ragas import evaluate
+        from ragas.metrics import faithfulness, answer_relevancy, context_recall, context_precision
+
         data = {
             "question": [self.question],
             "answer": [self.answer],
@@ -0,0 +1,212 @@
+import copy
+import os
+import threading
+from io import BytesIO
+from typing import Optional
+from fastapi import FastAPI, File, Form, Header, HTTPException, Response, UploadFile
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, JSONResponse
+from pydantic import BaseModel
+from PIL import Image
+from src import Models, Ingestion, Profiling
+from src.Figures import DERIVATIVES, derivative_path
+from src.Feedback import FeedbackJournal
+from src.Databases import Database
+from src.Pipeline import build_pipeline, config_from_env
+
+
+class RAGService:
+    """
+    Headless RAG pipeline of one server worker
+
+    Models are loaded once per worker process by load(), the vector stores are
+    shared with the other workers through LanceDB at uri
+    """
+
+    def __init__(self, uri='lancedb/rag', feedback_file='./feedback_journal.jsonl'):
+        self.uri = uri
+        self.feedback_file = feedback_file
+        self.ready = False
+        self.error = None
+        self.rag = None
+        self.lock = threading.Lock()
+        self._ingest_stamp = None
+        self._feedback_stamp = None
+
+    def load(self):
+        """
+        Loads all models and opens the stores already ingested
+        """
+
+        try:
+            self.chat_model = Models.load_chat_model()
+            self.q_model = Models.load_q_model()
+            self.cross_model = Models.load_cross()
+            self.extractor, self.image_model = Models.load_image_model("google/vit-base-patch16-224-in21k")
+            self.pinecone_embed = Models.pine_embedding_model()
+            self.weaviate_embed = Models.weaviate_embedding_model()
+            self.captioner = Models.load_captioner()
+            self._refresh()
+            self.ready = True
+        except Exception as e:
+            self.error = repr(e)
+            raise
+
+    @staticmethod
+    def _stamp(path):
+        return os.stat(path).st_mtime_ns if os.path.exists(path) else None
+
+    def _refresh(self):
+        """
+        Rebuilds the pipeline when a pdf was ingested since the last build, and reopens the
+        feedback table when feedback was synced since (the checkpoint of the journal is
+        rewritten by every sync), possibly by another worker: an open LanceDB table keeps
+        reading the version it was opened at
+        """
+
+        stamp = self._stamp(os.path.join(self.uri, 'ingested.json'))
+        feedback = self._stamp(FeedbackJournal(self.feedback_file).checkpoint)
+        if stamp == self._ingest_stamp and feedback == self._feedback_stamp and self.rag is not None:
+            return
+        with self.lock:
+            if stamp != self._ingest_stamp or self.rag is None:
+                vb_list = Ingestion.vector_databases(self.extractor, self.image_model,
+                                                     self.weaviate_embed, self.pinecone_embed, self.uri)
+                if all(vb.open() for vb in vb_list):
+                    self.rag = self._build(vb_list)
+                self._ingest_stamp = stamp
+            elif feedback != self._feedback_stamp:
+                self.rag.fd_db.open()
+            self._feedback_stamp = feedback
+
+    def _build(self, vb_list):
+        """
+        Same pipeline as pages/rag.py
+        """
+
+        config = dict(config_from_env(), uri=self.uri, feedback_file=self.feedback_file)
+        rag = build_pipeline(vb_list, self.chat_model, self.q_model, self.cross_model, self.weaviate_embed, config)
+        return rag._batched()  # concurrent requests share batched retrieval and reranking
+
+    def query(self, question, top_k=5, profile=None, request_id=None, document=None):
+        self._refresh()
+        if self.rag is None:
+            raise HTTPException(status_code=409, detail='No document has been ingested yet')
+        return copy.copy(self.rag).query(question, top_k, profile, request_id, document)
+
+    def ingest(self, file_name, content, profile=None, request_id=None):
+        os.makedirs(os.path.join(os.getcwd(), 'pdfs'), exist_ok=True)
+        with open(os.path.join(os.getcwd(), 'pdfs', file_name), 'wb') as f:
+            f.write(content)
+        with self.lock:
+            Ingestion.vector_database_prep(file_name, self.extractor, self.image_model,
+                                           self.weaviate_embed, self.pinecone_embed, self.uri, self.captioner,
+                                           profile, request_id)
+        self._refresh()
+        return Ingestion.ingested_files(self.uri)
+
+    def feedback(self, question, positive, response):
+        self._refresh()
+        if self.rag is None:
+            raise HTTPException(status_code=409, detail='No document has been ingested yet')
+        self.rag.feedback_journal.append(FeedbackJournal.record(question, positive, response))
+        self.rag.feedback_journal.sync(self.rag.fd_db)
+
+
+class Query(BaseModel):
+    question: str
+    top_k: int = 5
+    document: Optional[str] = None
+
+
+class Feedback(BaseModel):
+    question: str
+    positive: bool
+    response: str = ""
+
+
+service = RAGService(uri=os.getenv('RAG_URI', 'lancedb/rag'),
+                     feedback_file=os.getenv('RAG_FEEDBACK_FILE', './feedback_journal.jsonl'))
+app = FastAPI(title='Multi-modal RAG based LLM for Information Retrieval')
+
+
+@app.on_event('startup')
+def startup():
+    # loading runs in the background so that the liveness probe answers meanwhile
+    threading.Thread(target=service.load, daemon=True).start()
+
+
+def _ready():
+    if not service.ready:
+        raise HTTPException(status_code=503, detail=service.error or 'Models are loading')
+
+
+@app.get('/healthz')
+def healthz():
+    return {"status": "ok"}
+
+
+@app.get('/readyz')
+def readyz():
+    if not service.ready:
+        return JSONResponse(status_code=503, content={"status": "loading", "error": service.error})
+    return {"status": "ready", "documents": Ingestion.ingested_files(service.uri),
+            "retrieval_cache": Database.cache_stats()}
+
+
+def _profile(response, x_profile, x_request_id):
+    """
+    Profiling switch of a request: the X-Profile header when RAG_PROFILE_HEADER allows
+    clients to ask for profiles (otherwise RAG_PROFILE), and the X-Request-Id tagging its
+    artifacts, replaced when unsafe, echoed in the response
+    """
+
+    request_id = Profiling.safe_request_id(x_request_id)
+    response.headers['X-Request-Id'] = request_id
+    if x_profile is None or not Profiling.PROFILE_HEADER:
+        return None, request_id
+    return x_profile not in ('', '0', 'false'), request_id
+
+
+@app.post('/query')
+async def query(q: Query, response: Response, x_profile: str = Header(None), x_request_id: str = Header(None)):
+    _ready()
+    profile, request_id = _profile(response, x_profile, x_request_id)
+    return await run_in_threadpool(service.query, q.question, q.top_k, profile, request_id, q.document)
+
+
+@app.post('/query/image')
+async def query_image(response: Response, image: UploadFile = File(...), top_k: int = Form(5),
+                      document: str = Form(None), x_profile: str = Header(None), x_request_id: str = Header(None)):
+    _ready()
+    profile, request_id = _profile(response, x_profile, x_request_id)
+    up_image = Image.open(BytesIO(await image.read()))
+    return await run_in_threadpool(service.query, up_image, top_k, profile, request_id, document)
+
+
+@app.post('/ingest')
+async def ingest(response: Response, pdf: UploadFile = File(...),
+                 x_profile: str = Header(None), x_request_id: str = Header(None)):
+    _ready()
+    profile, request_id = _profile(response, x_profile, x_request_id)
+    file_name = os.path.basename(pdf.filename)
+    documents = await run_in_threadpool(service.ingest, file_name, await pdf.read(), profile, request_id)
+    return {"file": file_name, "documents": documents}
+
+
+@app.post('/feedback')
+async def feedback(f: Feedback):
+    _ready()
+    await run_in_threadpool(service.feedback, f.question, f.positive, f.response)
+    return {"status": "recorded"}
+
+
+@app.get('/figures/{file_name}/{image}')
+def figure(file_name: str, image: str, size: str = 'original'):
+    folder = os.path.realpath(os.path.join(os.getcwd(), f'figures_{file_name}'))
+    path = os.path.realpath(os.path.join(folder, image))
+    if size in DERIVATIVES and os.path.isfile(derivative_path(folder, image, size)):
+        path = os.path.realpath(derivative_path(folder, image, size))
+    if not path.startswith(folder + os.sep) or not os.path.isfile(path):
+        raise HTTPException(status_code=404, detail='Figure not found')
+    return FileResponse(path)
@@ -0,0 +1,192 @@
+"""
+Snapshot bundles of the ingested stores, to provision a new node without re-ingesting
+
+    python -m src.Snapshot export lancedb/rag ./snapshot
+    python -m src.Snapshot import ./snapshot lancedb/rag [--replace]
+
+A bundle is a directory with
+1. lancedb/: the Lance files of the vb1/vb2 image, text and children tables, the feedback
+   table, the figure indexes and ingested.json
+2. figures/: the figures_<file> folders of the ingested pdfs
+3. feedback/: the feedback journal and its checkpoint, so the records already in the
+   feedback table are not embedded again by the next sync
+4. manifest.json: bundle format version, table versions and the size and sha256 of every file
+"""
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import sys
+import time
+from src.Databases import TextDatabase, UnifiedDatabase
+from src.Feedback import FeedbackJournal
+from src.Ingestion import ingested_files
+
+SNAPSHOT_VERSION = 1
+STORES = ('vb1', 'vb2')
+FEEDBACK_TABLE = 'feedback'
+FEEDBACK_FILE = os.getenv('RAG_FEEDBACK_FILE', './feedback_journal.jsonl')
+JOURNAL, CHECKPOINT = 'journal.jsonl', 'journal.jsonl.offset'  # names in the bundle
+
+
+def _sha256(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(2 ** 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _files(root):
+    for folder, _, files in os.walk(root):
+        for name in files:
+            path = os.path.join(folder, name)
+            yield os.path.relpath(path, root)
+
+
+def export_snapshot(uri, path, stores=STORES, feedback_table=FEEDBACK_TABLE, feedback_file=FEEDBACK_FILE):
+    """
+    Writes the bundle of the stores at uri and of the feedback journal to path, returns its
+    manifest. Stores should not be written to while exporting
+    """
+
+    if os.path.exists(os.path.join(path, 'manifest.json')):
+        raise FileExistsError(f'{path} already holds a snapshot')
+    lance_dir = os.path.join(path, 'lancedb')
+    os.makedirs(lance_dir, exist_ok=True)
+    tables = {}
+    for name in stores:
+        vb = UnifiedDatabase(name, uri)
+        if not vb.open():
+            raise FileNotFoundError(f'Store {name} has not been ingested at {uri}')
+        tables.update(vb.export(lance_dir))
+    journal = FeedbackJournal(feedback_file)
+    os.makedirs(os.path.dirname(os.path.abspath(journal.checkpoint)), exist_ok=True)
+    with open(journal.checkpoint + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)  # the table and checkpoint of the same sync
+        feedback = TextDatabase(feedback_table, uri)
+        if feedback.open():
+            tables.update(feedback.export(lance_dir))
+            for file, name in ((journal.path, JOURNAL), (journal.checkpoint, CHECKPOINT)):
+                if os.path.exists(file):
+                    os.makedirs(os.path.join(path, 'feedback'), exist_ok=True)
+                    shutil.copy2(file, os.path.join(path, 'feedback', name))
+
+    documents = ingested_files(uri)
+    if documents:
+        shutil.copy2(os.path.join(uri, 'ingested.json'), lance_dir)
+    for file_name in documents:
+        folder = os.path.join(os.getcwd(), f'figures_{file_name}')
+        if os.path.isdir(folder):
+            shutil.copytree(folder, os.path.join(path, 'figures', f'figures_{file_name}'), dirs_exist_ok=True)
+
+    files = {f: {"size": os.path.getsize(os.path.join(path, f)), "sha256": _sha256(os.path.join(path, f))}
+             for f in sorted(_files(path))}
+    manifest = {"format": SNAPSHOT_VERSION, "created": time.time(), "tables": tables,
+                "documents": documents, "files": files}
+    with open(os.path.join(path, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=1)
+    return manifest
+
+
+def read_manifest(path):
+    with open(os.path.join(path, 'manifest.json')) as f:
+        return json.load(f)
+
+
+def verify_snapshot(path):
+    """
+    Returns the manifest of the bundle at path, raises ValueError if a file is missing or corrupt
+    """
+
+    manifest = read_manifest(path)
+    if manifest.get('format') != SNAPSHOT_VERSION:
+        raise ValueError(f"Snapshot format {manifest.get('format')} is not supported (expected {SNAPSHOT_VERSION})")
+    for name, meta in manifest['files'].items():
+        file = os.path.join(path, name)
+        if not os.path.isfile(file) or os.path.getsize(file) != meta['size'] or _sha256(file) != meta['sha256']:
+            raise ValueError(f'Snapshot file {name} is missing or corrupt')
+    return manifest
+
+
+def _link(src, dst):
+    """
+    Hard links src to dst (no copy), copies when they are on different file systems
+    Lance never rewrites its data files in place, so linking them is safe
+    """
+
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    if os.path.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def _targets(manifest, uri, feedback_file):
+    """
+    Bundle file -> destination, and the top-level destinations (table folders, figure
+    indexes and folders, journal files) the bundle replaces
+    """
+
+    journal = FeedbackJournal(feedback_file)
+    targets, roots = {}, set()
+    for name in manifest['files']:
+        folder, rest = name.split(os.sep, 1) if os.sep in name else ('', name)
+        if folder == 'feedback':
+            targets[name] = {JOURNAL: journal.path, CHECKPOINT: journal.checkpoint}[rest]
+            roots.add(targets[name])
+        elif folder in ('lancedb', 'figures') and rest != 'ingested.json':
+            base = uri if folder == 'lancedb' else os.getcwd()
+            targets[name] = os.path.join(base, rest)
+            roots.add(os.path.join(base, rest.split(os.sep)[0]))
+    return targets, roots
+
+
+def import_snapshot(path, uri, verify=True, replace=False, feedback_file=FEEDBACK_FILE):
+    """
+    Places the bundle at path in the stores at uri, the figure folders in the working
+    directory and the feedback journal at feedback_file, returns the manifest
+
+    Raises FileExistsError when a table, figure index or folder, or the journal of the
+    bundle already exists, unless replace, which deletes them first (a Lance folder left in
+    place would keep its own versions). Files are hard linked, so the Lance tables open in
+    place without copying data, the journal, appended to, is copied. ingested.json is
+    written last, servers watching it (see Server.RAGService) then reopen the stores
+    """
+
+    manifest = verify_snapshot(path) if verify else read_manifest(path)
+    targets, roots = _targets(manifest, uri, feedback_file)
+    existing = sorted(r for r in roots if os.path.lexists(r))
+    if existing and not replace:
+        raise FileExistsError(f'{len(existing)} tables, indexes or folders of the snapshot already exist '
+                              f'({", ".join(existing[:3])}), import with replace=True to overwrite them')
+    for root in existing:
+        if os.path.isdir(root) and not os.path.islink(root):
+            shutil.rmtree(root)
+        else:
+            os.remove(root)
+    for name, dst in targets.items():
+        if name.startswith('feedback' + os.sep):
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            shutil.copy2(os.path.join(path, name), dst)
+        else:
+            _link(os.path.join(path, name), dst)
+    ingested = os.path.join(path, 'lancedb', 'ingested.json')
+    if os.path.exists(ingested):
+        shutil.copy2(ingested, os.path.join(uri, 'ingested.json.tmp'))
+        os.replace(os.path.join(uri, 'ingested.json.tmp'), os.path.join(uri, 'ingested.json'))
+    return manifest
+
+
+if __name__ == '__main__':
+    args = [a for a in sys.argv[1:] if a != '--replace']
+    if len(args) != 3 or args[0] not in ('export', 'import'):
+        sys.exit(__doc__)
+    if args[0] == 'export':
+        m = export_snapshot(args[1], args[2])
+    else:
+        m = import_snapshot(args[1], args[2], replace='--replace' in sys.argv)
+    print(json.dumps({"tables": m['tables'], "documents": m['documents'], "files": len(m['files'])}, indent=1))